@@ -0,0 +1,130 @@
+"""
+Adaptive early-stopping sampler for NSQL generation.
+"""
+
+import math
+import time
+from typing import Dict, List, Tuple
+
+from generation.generator import Generator
+from nsql.nsql_exec import Executor, NeuralDB
+from utils.errors import CassetteMissError
+from utils.normalizer import post_process_sql
+from utils.utils import majority_vote_is_decided, majority_vote_scores, count_tokens
+
+
+class AdaptiveSampler(object):
+    """
+    Sample the programs in rounds of sampling_round_n, execute them and update the majority vote.
+    A question stops sampling once its leading answer can no longer be overtaken by the rest samples,
+    or the leading answer has at least the confidence share of the votes.
+    """
+
+    def __init__(self, args, generator: Generator, executor: Executor):
+        self.args = args
+        self.generator = generator
+        self.executor = executor
+        self.sampling_n = args.sampling_n
+        self.round_n = args.sampling_round_n
+        self.confidence = args.sampling_confidence
+        self.min_n = args.sampling_min_n
+
+    def _execute(self, nsql: str, data_item: Dict):
+        table = data_item['table']
+        title = table['page_title']
+        try:
+            with NeuralDB(
+                    tables=[{"title": title, "table": table}],
+                    tmp_path=getattr(self.args, 'neuraldb_tmp_dir', None)
+            ) as db:
+                nsql = post_process_sql(
+                    sql_str=nsql,
+                    df=db.get_table_df(),
+                    process_program_with_fuzzy_match_on_db=self.args.process_program_with_fuzzy_match_on_db,
+                    table_title=title
+                )
+                exec_answer = self.executor.nsql_exec(nsql, db, verbose=self.args.verbose)
+            if isinstance(exec_answer, str):
+                exec_answer = [exec_answer]
+            return exec_answer
+        except CassetteMissError:
+            raise
+        except Exception as e:
+            print(f"Execution error {e}")
+            return '<error>'
+
+    def _is_decided(self, nsqls: List, exec_answers: List):
+        vote_kwargs = dict(
+            allow_none_and_empty_answer=self.args.allow_none_and_empty_answer,
+            answer_placeholder=self.args.answer_placeholder,
+            vote_method=self.args.vote_method,
+            answer_biased=self.args.answer_biased,
+            answer_biased_weight=self.args.answer_biased_weight
+        )
+        if majority_vote_is_decided(nsqls, exec_answers, n_remaining=self.sampling_n - len(nsqls), **vote_kwargs):
+            return True
+        if self.confidence is None or len(nsqls) < self.min_n:
+            return False
+        answer_scores = majority_vote_scores(nsqls, exec_answers, **vote_kwargs)
+        total_score = sum([score for _, score in answer_scores])
+        return total_score > 0 and answer_scores[0][1] / total_score >= self.confidence
+
+    def generate_one_pass(
+            self,
+            prompts: List[Tuple],
+            data_items: Dict,
+            verbose: bool = False
+    ):
+        """
+        Generate like Generator.generate_one_pass, with the raw data items(by eid) to execute the programs on.
+        Return the response dict and the sampling stats of each eid.
+        """
+        response_dict = {eid: [] for eid, _ in prompts}
+        exec_answer_dict = {eid: [] for eid, _ in prompts}
+        seconds_dict = {eid: 0. for eid, _ in prompts}
+        n_rounds_dict = {eid: 0 for eid, _ in prompts}
+        active_prompts = list(prompts)
+        sample_round = 0
+        while active_prompts:
+            n = min(self.round_n, self.sampling_n - sample_round * self.round_n)
+            start_time = time.time()
+            round_response_dict = self.generator.generate_one_pass(
+                prompts=active_prompts,
+                verbose=verbose,
+                n=n,
+                sample_round=sample_round
+            )
+            round_seconds = time.time() - start_time
+            sample_round += 1
+
+            next_active_prompts = []
+            for eid, prompt in active_prompts:
+                seconds_dict[eid] += round_seconds
+                n_rounds_dict[eid] += 1
+                for nsql, logprob in round_response_dict.get(eid, []):
+                    response_dict[eid].append((nsql, logprob))
+                    exec_answer_dict[eid].append(self._execute(nsql, data_items[eid]))
+                n_sampled = sample_round * self.round_n
+                if n_sampled < self.sampling_n and not self._is_decided(response_dict[eid], exec_answer_dict[eid]):
+                    next_active_prompts.append((eid, prompt))
+            active_prompts = next_active_prompts
+
+        # Estimate the saving against sampling all the sampling_n programs in one call
+        stats_dict = dict()
+        for eid, prompt in prompts:
+            n_sampled = len(response_dict[eid])
+            n_saved = self.sampling_n - n_sampled
+            n_prompt_tokens = count_tokens(prompt)
+            avg_completion_tokens = sum([count_tokens(nsql) for nsql, _ in response_dict[eid]]) / max(n_sampled, 1)
+            tokens_saved = n_saved * avg_completion_tokens - (n_rounds_dict[eid] - 1) * n_prompt_tokens
+            seconds_saved = n_saved * seconds_dict[eid] / max(n_sampled, 1)
+            stats_dict[eid] = {
+                'n_sampled': n_sampled,
+                'n_rounds': n_rounds_dict[eid],
+                'tokens_saved': int(math.floor(tokens_saved)),
+                'seconds_saved': round(seconds_saved, 2),
+                'exec_answers': exec_answer_dict[eid]
+            }
+            print(f"eid#{eid}: sampled {n_sampled}/{self.sampling_n} programs in {n_rounds_dict[eid]} rounds, "
+                  f"saved about {stats_dict[eid]['tokens_saved']} tokens and {stats_dict[eid]['seconds_saved']}s.")
+        return response_dict, stats_dict
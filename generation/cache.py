@@ -0,0 +1,144 @@
+"""
+Persistent content-addressed cache for openai api completions.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+def request_key(request: Dict) -> str:
+    """
+    Content hash of an api request(engine, prompt or messages, sampling params and stop tokens).
+    """
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+
+
+class CompletionCache(object):
+    """
+    SQLite backed key-value cache for api completions.
+    Each process(and each pickled copy) opens its own connection lazily, and SQLite handles the locking,
+    so one cache file can be shared by all the multiprocessing workers.
+    """
+
+    def __init__(
+            self,
+            db_path: str,
+            max_entries: int = 100000,
+            table_name: str = 'completions',
+            evict_every: int = 64
+    ):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.table_name = table_name
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._n_puts = 0
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        dir_name = os.path.dirname(db_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+
+    @staticmethod
+    def from_args(args) -> Optional['CompletionCache']:
+        """
+        Build the cache from script args, return None when no cache file is set.
+        """
+        db_path = getattr(args, 'completion_cache_file', None) if args else None
+        if not db_path:
+            return None
+        return CompletionCache(
+            db_path=db_path,
+            max_entries=getattr(args, 'completion_cache_max_entries', 100000)
+        )
+
+    def __getstate__(self):
+        # The sqlite connection and lock are not picklable, they will be rebuilt in the new process.
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_conn_pid'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_conn(self):
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)".format(self.table_name)
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_last_access ON {0}(last_access)".format(self.table_name)
+            )
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str):
+        """
+        Return the cached value of the key, None when missing.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            row = conn.execute(
+                "SELECT value FROM {} WHERE key = ?".format(self.table_name), (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            conn.execute(
+                "UPDATE {} SET last_access = ? WHERE key = ?".format(self.table_name), (time.time(), key)
+            )
+            conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key: str, value):
+        """
+        Store the value, the least recently used entries are evicted when exceeding max_entries.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO {} (key, value, last_access) VALUES (?, ?, ?)".format(self.table_name),
+                (key, json.dumps(value, ensure_ascii=False), time.time())
+            )
+            conn.commit()
+            self._n_puts += 1
+            if self.max_entries and self._n_puts % self.evict_every == 0:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        n_entries = conn.execute("SELECT COUNT(*) FROM {}".format(self.table_name)).fetchone()[0]
+        if n_entries <= self.max_entries:
+            return
+        conn.execute(
+            "DELETE FROM {0} WHERE key IN (SELECT key FROM {0} ORDER BY last_access ASC LIMIT ?)".format(
+                self.table_name),
+            (n_entries - self.max_entries,)
+        )
+        conn.commit()
+
+    def stats(self) -> Dict:
+        n_queries = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_queries if n_queries else 0.
+        }
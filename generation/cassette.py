@@ -0,0 +1,95 @@
+"""
+Record and replay the api requests and responses of a pipeline run.
+"""
+
+import fcntl
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from utils.errors import CassetteMissError
+
+
+class Cassette(object):
+    """
+    Append-only jsonl file of {"key", "request", "response"}.
+    In record mode each completed request is appended(with a file lock, so that workers can share the file),
+    in replay mode all responses are served from the file and a missing request raises CassetteMissError.
+    """
+
+    def __init__(self, path: str, mode: str):
+        assert mode in ['record', 'replay'], "Cassette mode must be record or replay"
+        self.path = path
+        self.mode = mode
+        self.n_recorded = 0
+        self.n_replayed = 0
+        self._responses = None
+        self._lock = threading.Lock()
+        if mode == 'record':
+            dir_name = os.path.dirname(path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+        elif not os.path.exists(path):
+            raise CassetteMissError("Cassette file {} to replay does not exist".format(path))
+
+    @staticmethod
+    def from_args(args) -> Optional['Cassette']:
+        """
+        Build the cassette from script args, return None in live mode.
+        """
+        llm_mode = getattr(args, 'llm_mode', 'live') if args else 'live'
+        if llm_mode == 'live':
+            return None
+        assert args.llm_cassette_file, "--llm_cassette_file is required to {}".format(llm_mode)
+        return Cassette(args.llm_cassette_file, llm_mode)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_responses'] = None
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        responses = dict()
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                responses[record['key']] = record['response']
+        return responses
+
+    def replay(self, key: str, request: Dict):
+        with self._lock:
+            if self._responses is None:
+                self._responses = self._load()
+            response = self._responses.get(key, None)
+            if response is None:
+                raise CassetteMissError("Request {} is not recorded in cassette {}: {}".format(
+                    key, self.path, json.dumps(request, ensure_ascii=False)[:500]))
+            self.n_replayed += 1
+            return response
+
+    def record(self, key: str, request: Dict, response: Dict):
+        line = json.dumps({"key": key, "request": request, "response": response}, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(line)
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            self.n_recorded += 1
+
+    def stats(self) -> Dict:
+        return {
+            'mode': self.mode,
+            'n_recorded': self.n_recorded,
+            'n_replayed': self.n_replayed
+        }
@@ -0,0 +1,57 @@
+"""
+Local LLM gateway process shared by all the pipeline workers.
+"""
+
+from multiprocessing.managers import BaseManager
+from typing import Dict, List
+
+from generation.generator import Generator
+from generation.cache import CompletionCache
+from generation.key_scheduler import KeyScheduler
+
+
+class LLMGateway(object):
+    """
+    Serve the completion requests of all workers.
+    It owns the key pool and its rate limits, the response cache, and deduplicates identical requests in flight.
+    """
+
+    def __init__(self, args, keys: List[str]):
+        self.generator = Generator(
+            args=None,
+            keys=keys,
+            cache=CompletionCache.from_args(args),
+            key_scheduler=KeyScheduler.from_args(args, keys),
+            llm_args=args
+        )
+        # The workers record and replay the cassette themselves, the gateway would record every request twice
+        self.generator.cassette = None
+
+    def complete(self, request: Dict):
+        """
+        Complete one api request, wait for the identical request if it is already in flight.
+        """
+        return self.generator._complete(request)
+
+    def stats(self) -> Dict:
+        stats = self.generator.stats()
+        stats['keys'] = self.generator.key_scheduler.stats()
+        return stats
+
+
+class LLMGatewayManager(BaseManager):
+    pass
+
+
+LLMGatewayManager.register('LLMGateway', LLMGateway)
+
+
+def start_llm_gateway_server(args, keys: List[str]):
+    """
+    Start the gateway process(reached over a unix socket), return the manager and the gateway proxy.
+    The proxy is picklable, pass it to the multiprocessing workers and give it to Generator as the gateway.
+    """
+    manager = LLMGatewayManager()
+    manager.start()
+    gateway = manager.LLMGateway(args, keys)
+    return manager, gateway
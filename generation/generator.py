@@ -3,10 +3,17 @@ Generate nsql and questions.
 """
 
 from typing import Dict, List, Union, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import openai
 import time
 
 from generation.prompt import PromptBuilder
+from generation.cache import CompletionCache, request_key
+from generation.cassette import Cassette
+from generation.key_scheduler import KeyScheduler
+from generation.single_flight import SingleFlight
+from utils.utils import count_tokens
 
 
 class Generator(object):
@@ -14,14 +21,75 @@ class Generator(object):
     Codex generation wrapper.
     """
 
-    def __init__(self, args, keys=None):
+    def __init__(
+            self,
+            args,
+            keys=None,
+            cache: CompletionCache = None,
+            key_scheduler: KeyScheduler = None,
+            gateway=None,
+            llm_args=None
+    ):
         self.args = args
         self.keys = keys
-        self.current_key_id = 0
+
+        # Options of the api calls(cache, concurrency, batching...), the same as args if not given
+        llm_args = llm_args if llm_args is not None else args
+
+        # Proxy of the LLMGateway process, when given all the requests are sent through it
+        self.gateway = gateway
+
+        # Key scheduler, a process-local one if not given(pass a proxy to share it among processes)
+        if key_scheduler is None and keys:
+            key_scheduler = KeyScheduler.from_args(llm_args, keys)
+        self.key_scheduler = key_scheduler
+
+        # Completion cache shared by all the api calls, read from args if not given
+        self.cache = cache if cache is not None else CompletionCache.from_args(llm_args)
+
+        # Record the requests and responses to a cassette file, or replay them from it
+        self.cassette = Cassette.from_args(llm_args)
+
+        # Identical requests in flight at the same time are sent only once
+        self.single_flight = SingleFlight()
+
+        # Max number of in-flight api requests, the blocking api calls run in a thread pool of this size
+        self.max_concurrent_requests = getattr(llm_args, 'max_concurrent_requests', 8) if llm_args else 8
+        # Created here rather than on the first call, concurrent first calls would each create a pool
+        self._thread_pool = ThreadPoolExecutor(max_workers=self.max_concurrent_requests)
+
+        # Base url of an openai-compatible server(e.g., scripts/openai_stub_server.py), openai's if not given
+        self.api_base = getattr(llm_args, 'api_base', None) if llm_args else None
+
+        # Pack up to this many prompts within the token budget into one call of the legacy completion endpoint
+        self.completion_batch_size = getattr(llm_args, 'completion_batch_size', 1) if llm_args else 1
+        self.completion_batch_max_tokens = getattr(llm_args, 'completion_batch_max_tokens', 32000) \
+            if llm_args else 32000
 
         # if the args provided, will initialize with the prompt builder for full usage
         self.prompt_builder = PromptBuilder(args) if args else None
 
+    def __getstate__(self):
+        # The thread pool is not picklable, rebuild it in the new process.
+        state = self.__dict__.copy()
+        del state['_thread_pool']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._thread_pool = ThreadPoolExecutor(max_workers=self.max_concurrent_requests)
+
+    def stats(self) -> Dict:
+        """
+        Counters of the cache and the coalesced requests in this process.
+        """
+        stats = {'single_flight': self.single_flight.stats()}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        if self.cassette is not None:
+            stats['cassette'] = self.cassette.stats()
+        return stats
+
     def prompt_row_truncate(
             self,
             prompt: str,
@@ -90,14 +158,31 @@ class Generator(object):
     def generate_one_pass(
             self,
             prompts: List[Tuple],
-            verbose: bool = False
+            verbose: bool = False,
+            n: int = None,
+            sample_round: int = None
     ):
         """
         Generate one pass with codex according to the generation phase.
+        n overrides args.sampling_n, and sample_round distinguishes the cache keys of repeated sampling rounds.
         """
+        return asyncio.run(self.agenerate_one_pass(prompts, verbose=verbose, n=n, sample_round=sample_round))
+
+    async def agenerate_one_pass(
+            self,
+            prompts: List[Tuple],
+            verbose: bool = False,
+            n: int = None,
+            sample_round: int = None
+    ):
+        """
+        Coroutine version of generate_one_pass, all prompts are requested concurrently.
+        Await several of them together to overlap the generation of several batches.
+        """
+        n = n if n is not None else self.args.sampling_n
         result_idx_to_eid = []
         for p in prompts:
-            result_idx_to_eid.extend([p[0]] * self.args.sampling_n)
+            result_idx_to_eid.extend([p[0]] * n)
         prompts = [p[1] for p in prompts]
         start_time = time.time()
 
@@ -106,15 +191,16 @@ class Generator(object):
                                        "gpt-3.5-turbo-16k-0613",
                                        "gpt-4", "gpt-4-0613"]
 
-        result = self._call_openai_api(
+        result = await self._acall_openai_api(
             engine=self.args.engine,
             prompt=prompts,
             max_tokens=self.args.max_generation_tokens,
             temperature=self.args.temperature,
             top_p=self.args.top_p,
-            n=self.args.sampling_n,
+            n=n,
             stop=self.args.stop_tokens,
-            is_chat=is_chat
+            is_chat=is_chat,
+            sample_round=sample_round
         )
         print(f'Openai api one inference time: {time.time() - start_time}')
 
@@ -158,80 +244,379 @@ class Generator(object):
 
         return response_dict
 
-    def _call_openai_api(
+    def _build_request(
             self,
             engine: str,
-            prompt: Union[str, List],
+            prompt_item: str,
             max_tokens,
             temperature: float,
             top_p: float,
             n: int,
             stop: List[str],
-            is_chat=True
+            is_chat=True,
+            sample_round: int = None,
+            stream_map_rows: int = None,
+            stream_map_header: str = None,
+            stream_map_token: str = None
     ):
-        start_time = time.time()
-        result = None
-        while result is None:
+        """
+        Build the api request of one prompt, which is also the content to hash as the cache key.
+        """
+        request = {
+            "engine": engine,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "n": n,
+            "stop": stop,
+            "is_chat": is_chat
+        }
+        if is_chat:
+            request["messages"] = [
+                {"role": "system",
+                 "content": "I will give you some x-y examples followed by a x, you need to give me the y, and no other content."},
+                {"role": "user", "content": prompt_item},
+            ]
+        else:
+            request["prompt"] = prompt_item
+            request["logprobs"] = 1
+        if self.api_base:
+            request["api_base"] = self.api_base
+        if sample_round is not None:
+            # Not sent to the api, only to tell apart the samples of different rounds
+            request["sample_round"] = sample_round
+        if stream_map_rows is not None:
+            # Stream the map@ completion and stop once this many rows are produced, or the output diverges from
+            # the header line and the rows mapped by the token
+            request["stream_map_rows"] = stream_map_rows
+            request["stream_map_header"] = stream_map_header
+            request["stream_map_token"] = stream_map_token
+        return request
+
+    def _complete(self, request: Dict):
+        """
+        Get the completion of one request, from the cassette, the gateway or the cache if possible.
+        """
+        key = request_key(request)
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return self.cassette.replay(key, request)
+        if self.gateway is not None:
+            response = self.gateway.complete(request)
+        else:
+            response = self.single_flight.do(key, self._complete_from_cache_or_api, request, key)
+        if self.cassette is not None:
+            self.cassette.record(key, request, response)
+        return response
+
+    def _complete_from_cache_or_api(self, request: Dict, key: str):
+        if self.cache is not None:
+            response = self.cache.get(key)
+            if response is not None:
+                return response
+        return self._complete_from_api(request, key)
+
+    def _complete_from_api(self, request: Dict, key: str):
+        response = self._request_openai_api(request)
+        if self.cache is not None:
+            self.cache.put(key, response)
+        return response
+
+    def _complete_missing(self, request: Dict):
+        """
+        Complete one request already looked up and missed in the cache, without looking it up again.
+        """
+        key = request_key(request)
+        return self.single_flight.do(key, self._complete_from_api, request, key)
+
+    @staticmethod
+    def _estimate_request_tokens(request: Dict):
+        """
+        Rough token number of a request(about 4 chars per token) to reserve from the key budget.
+        """
+        if request["is_chat"]:
+            prompts = [message["content"] for message in request["messages"]]
+            n_outputs = request["n"]
+        else:
+            # The legacy completion endpoint also takes a list of prompts
+            prompts = request["prompt"] if isinstance(request["prompt"], list) else [request["prompt"]]
+            n_outputs = request["n"] * len(prompts)
+        return sum([len(prompt) for prompt in prompts]) // 4 + request["max_tokens"] * n_outputs
+
+    def _request_openai_api(self, request: Dict):
+        """
+        Send one request to openai with the key scheduled, retry until succeed.
+        """
+        is_chat = request["is_chat"]
+        stream = request.get("stream_map_rows", None) is not None
+        n_tokens_reserved = self._estimate_request_tokens(request)
+        while True:
+            key = self.key_scheduler.acquire(n_tokens_reserved)
             try:
-                key = self.keys[self.current_key_id]
-                self.current_key_id = (self.current_key_id + 1) % len(self.keys)
                 print(f"Using openai api key: {key}")
 
                 if is_chat:
-                    choices = []
-                    if isinstance(prompt, str):
-                        prompt = [prompt]
-                    for prompt_item in prompt:
-                        re = openai.ChatCompletion.create(
-                            model=engine,
-                            messages=[
-                                {"role": "system",
-                                 "content": "I will give you some x-y examples followed by a x, you need to give me the y, and no other content."},
-                                {"role": "user", "content": prompt_item},
-                            ],
-                            api_key=key,
-                            max_tokens=max_tokens,
-                            temperature=temperature,
-                            top_p=top_p,
-                            n=n,
-                            stop=stop,
-                        )
-                        choices += re["choices"]
-                    result = {"choices": choices}
-                    print('Openai api inference time:', time.time() - start_time)
-                    return result
-
+                    re = openai.ChatCompletion.create(
+                        model=request["engine"],
+                        messages=request["messages"],
+                        api_key=key,
+                        api_base=request.get("api_base", None),
+                        max_tokens=request["max_tokens"],
+                        temperature=request["temperature"],
+                        top_p=request["top_p"],
+                        n=request["n"],
+                        stop=request["stop"],
+                        stream=stream
+                    )
                 else:
-                    choices = []
-                    if isinstance(prompt, str):
-                        prompt = [prompt]
-                    for prompt_item in prompt:
-                        re = openai.Completion.create(
-                            engine=engine,
-                            prompt=prompt_item,
-                            api_key=key,
-                            max_tokens=max_tokens,
-                            temperature=temperature,
-                            top_p=top_p,
-                            n=n,
-                            stop=stop,
-                            logprobs=1
-                        )
-                        choices += re["choices"]
-                    result = {"choices": choices}
-                    print('Openai api inference time:', time.time() - start_time)
-                    return result
+                    re = openai.Completion.create(
+                        engine=request["engine"],
+                        prompt=request["prompt"],
+                        api_key=key,
+                        api_base=request.get("api_base", None),
+                        max_tokens=request["max_tokens"],
+                        temperature=request["temperature"],
+                        top_p=request["top_p"],
+                        n=request["n"],
+                        stop=request["stop"],
+                        logprobs=request["logprobs"],
+                        stream=stream
+                    )
+                if stream:
+                    text = self._read_map_stream(re, is_chat, request["stream_map_rows"],
+                                                 header=request.get("stream_map_header", None),
+                                                 mapping_token=request.get("stream_map_token", None))
+                    # No usage in a stream, give back the reserved completion tokens beyond the text read
+                    self.key_scheduler.report_success(
+                        key,
+                        n_tokens_reserved=n_tokens_reserved,
+                        n_tokens_used=n_tokens_reserved - request["max_tokens"] * request["n"] + count_tokens(text)
+                    )
+                    return {"choices": [{"message": {"content": text}} if is_chat else {"text": text}], "usage": None}
+                usage = re.get("usage", None)
+                self.key_scheduler.report_success(
+                    key,
+                    n_tokens_reserved=n_tokens_reserved,
+                    n_tokens_used=usage["total_tokens"] if usage else None
+                )
+                return {"choices": re["choices"], "usage": usage}
+            except openai.error.RateLimitError as e:
+                retry_after = getattr(e, 'headers', None) and e.headers.get('retry-after', None)
+                print(e, f'Rate limited, retry after {retry_after}s.' if retry_after else 'Rate limited, retry.')
+                self.key_scheduler.report_failure(key, retry_after=float(retry_after) if retry_after else None)
             except openai.error.InvalidRequestError as e:
+                # The request is invalid regardless of the key
+                self.key_scheduler.report_success(key, n_tokens_reserved=n_tokens_reserved, n_tokens_used=0)
                 # fixme: hardcoded, fix when refactoring
                 if "This model's maximum context length is" in str(e):
                     print(e)
                     print("Set a place holder, and skip this example")
-                    result = {"choices": [{"message": {"content": "PLACEHOLDER"}}]} if is_chat \
-                        else {"choices": [{"text": "PLACEHOLDER"}]}
-                    print('Openai api inference time:', time.time() - start_time)
+                    # n placeholders per prompt, the callers map the choices back to the prompts by their count
+                    n_prompts = len(request["prompt"]) if not is_chat and isinstance(request["prompt"], list) else 1
+                    return {"choices": [{"message": {"content": "PLACEHOLDER"}} if is_chat
+                                        else {"text": "PLACEHOLDER"} for _ in range(request["n"] * n_prompts)]}
                 else:
                     print(e, 'Retry.')
                     time.sleep(3)
             except Exception as e:
                 print(e, 'Retry.')
-                time.sleep(3)
+                self.key_scheduler.report_failure(key)
+
+    @staticmethod
+    def _read_map_stream(stream, is_chat: bool, n_rows: int, header: str = None, mapping_token: str = None):
+        """
+        Read a streamed map@ completion in new_db style('/*', header, one line per row, '*/') line by line.
+        Stop reading as soon as all n_rows rows are produced or the output diverges from the table format:
+        not opened by '/*', a header line other than the given one, or a row line without the mapped answer.
+        """
+        text = ''
+        for chunk in stream:
+            choice = chunk["choices"][0]
+            if choice.get("index", 0) != 0:
+                continue
+            text += (choice["delta"].get("content", None) or '') if is_chat else choice["text"]
+            lines = text.split("\n")[:-1]  # The completed lines
+            if len(lines) == 0:
+                continue
+            if not lines[0].strip().startswith('/*') or \
+                    not Generator._is_map_stream_in_format(lines[1:], header, mapping_token):
+                print("Streamed map@ output diverges from the table format, abort.")
+                break
+            if any([line.strip() == '*/' for line in lines[1:]]):
+                break
+            if len(lines) - 2 >= n_rows:
+                # All rows are produced, close the table ourselves instead of waiting for the rest tokens
+                text = '\n'.join(lines[:2 + n_rows] + ['*/'])
+                break
+        if hasattr(stream, 'close'):
+            stream.close()
+        return text
+
+    @staticmethod
+    def _is_map_stream_in_format(lines: List[str], header: str = None, mapping_token: str = None):
+        """
+        Whether the completed lines after '/*' are the header line, then rows mapped to answers by mapping_token.
+        """
+        if header is not None and lines:
+            # The header line is written by table2codex_prompt, columns joined by '\t'
+            if [cell.strip().lower() for cell in lines[0].split('\t')] != \
+                    [cell.strip().lower() for cell in header.split('\t')]:
+                return False
+        if mapping_token is not None:
+            # A row copies the cells of the header columns and appends the answer after one more mapping token
+            n_tokens = header.count(mapping_token) + 1 if header is not None else 1
+            for line in lines[1:]:
+                if line.strip() == '*/':
+                    break
+                if line.count(mapping_token) < n_tokens:
+                    return False
+        return True
+
+    async def _acomplete(self, request: Dict):
+        """
+        Run the blocking _complete in the thread pool, at most max_concurrent_requests at the same time.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._thread_pool, self._complete, request)
+
+    def _pack_batches(self, requests: List[Dict]):
+        """
+        Greedily pack consecutive requests into batches of completion_batch_size within the token budget.
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for idx, request in enumerate(requests):
+            n_tokens = count_tokens(request["prompt"]) + request["max_tokens"] * request["n"]
+            if batch and (len(batch) >= self.completion_batch_size
+                          or batch_tokens + n_tokens > self.completion_batch_max_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(idx)
+            batch_tokens += n_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _acomplete_batch(self, requests: List[Dict]):
+        """
+        Send the legacy completion requests as one call with a list of prompts, and split the choices back.
+        The requests are the ones missed in the cache by _acomplete_batched.
+        """
+        loop = asyncio.get_event_loop()
+        if len(requests) == 1:
+            return [await loop.run_in_executor(self._thread_pool, self._complete_missing, requests[0])]
+        n = requests[0]["n"]
+        batched_request = dict(requests[0])
+        batched_request["prompt"] = [request["prompt"] for request in requests]
+        response = await loop.run_in_executor(self._thread_pool, self._request_openai_api, batched_request)
+        choices = response["choices"]
+        if len(choices) != n * len(requests) or any(["index" not in choice for choice in choices]):
+            # E.g., a placeholder when some prompt exceeds the max context length, request them one by one
+            return await asyncio.gather(*[loop.run_in_executor(self._thread_pool, self._complete_missing, request)
+                                          for request in requests])
+
+        # The choice of the i-th prompt has index in [i * n, (i + 1) * n)
+        responses = [{"choices": [], "usage": None} for _ in requests]
+        for choice in sorted(choices, key=lambda x: x["index"]):
+            responses[choice["index"] // n]["choices"].append(choice)
+        if self.cache is not None:
+            for request, _response in zip(requests, responses):
+                self.cache.put(request_key(request), _response)
+        return responses
+
+    async def _acomplete_batched(self, requests: List[Dict]):
+        """
+        Complete the legacy completion requests, with the ones missing in the cache batched into fewer calls.
+        """
+        responses = [None] * len(requests)
+        if self.cache is not None:
+            for idx, request in enumerate(requests):
+                responses[idx] = self.cache.get(request_key(request))
+        missing_requests = [request for request, response in zip(requests, responses) if response is None]
+        missing_idxs = [idx for idx, response in enumerate(responses) if response is None]
+
+        batches = self._pack_batches(missing_requests)
+        batch_responses = await asyncio.gather(
+            *[self._acomplete_batch([missing_requests[idx] for idx in batch]) for batch in batches]
+        )
+        for batch, _batch_responses in zip(batches, batch_responses):
+            for idx, response in zip(batch, _batch_responses):
+                responses[missing_idxs[idx]] = response
+        print(f'Batched {len(missing_requests)} prompts into {len(batches)} api calls.')
+        return responses
+
+    async def _acall_openai_api(
+            self,
+            engine: str,
+            prompt: Union[str, List],
+            max_tokens,
+            temperature: float,
+            top_p: float,
+            n: int,
+            stop: List[str],
+            is_chat=True,
+            sample_round: int = None,
+            stream_map_rows: int = None,
+            stream_map_header: str = None,
+            stream_map_token: str = None
+    ):
+        """
+        Request all the prompts concurrently, and gather the choices in the order of prompts.
+        """
+        start_time = time.time()
+        if isinstance(prompt, str):
+            prompt = [prompt]
+        requests = [
+            self._build_request(
+                engine=engine,
+                prompt_item=prompt_item,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                n=n,
+                stop=stop,
+                is_chat=is_chat,
+                sample_round=sample_round,
+                stream_map_rows=stream_map_rows,
+                stream_map_header=stream_map_header,
+                stream_map_token=stream_map_token
+            ) for prompt_item in prompt
+        ]
+        if not is_chat and self.completion_batch_size > 1 and self.gateway is None and self.cassette is None \
+                and stream_map_rows is None and len(requests) > 1:
+            responses = await self._acomplete_batched(requests)
+        else:
+            responses = await asyncio.gather(*[self._acomplete(request) for request in requests])
+        choices = []
+        for response in responses:
+            choices += response["choices"]
+        print('Openai api inference time:', time.time() - start_time)
+        return {"choices": choices}
+
+    def _call_openai_api(
+            self,
+            engine: str,
+            prompt: Union[str, List],
+            max_tokens,
+            temperature: float,
+            top_p: float,
+            n: int,
+            stop: List[str],
+            is_chat=True,
+            sample_round: int = None,
+            stream_map_rows: int = None,
+            stream_map_header: str = None,
+            stream_map_token: str = None
+    ):
+        return asyncio.run(self._acall_openai_api(
+            engine=engine,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            n=n,
+            stop=stop,
+            is_chat=is_chat,
+            sample_round=sample_round,
+            stream_map_rows=stream_map_rows,
+            stream_map_header=stream_map_header,
+            stream_map_token=stream_map_token
+        ))
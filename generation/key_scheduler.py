@@ -0,0 +1,164 @@
+"""
+Rate-limit and health aware scheduler of openai api keys.
+"""
+
+import random
+import threading
+import time
+from multiprocessing.managers import BaseManager
+from typing import Dict, List
+
+
+class _KeyState(object):
+    """
+    Token buckets of requests and tokens per minute, and the quarantine state of one key.
+    """
+
+    def __init__(self, rpm_limit: int, tpm_limit: int):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.request_budget = float(rpm_limit)
+        self.token_budget = float(tpm_limit)
+        self.last_refill = time.time()
+        self.quarantine_until = 0.
+        self.n_failures = 0
+
+    def refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.request_budget = min(self.rpm_limit, self.request_budget + elapsed * self.rpm_limit / 60.)
+        self.token_budget = min(self.tpm_limit, self.token_budget + elapsed * self.tpm_limit / 60.)
+        self.last_refill = now
+
+    def headroom(self):
+        return min(self.request_budget / self.rpm_limit, self.token_budget / self.tpm_limit)
+
+    def seconds_until_ready(self, n_tokens: int, now: float):
+        """
+        Time to wait until this key could serve a request of n_tokens.
+        """
+        wait = max(0., self.quarantine_until - now)
+        if self.request_budget < 1:
+            wait = max(wait, (1 - self.request_budget) * 60. / self.rpm_limit)
+        n_tokens = min(n_tokens, self.tpm_limit)
+        if self.token_budget < n_tokens:
+            wait = max(wait, (n_tokens - self.token_budget) * 60. / self.tpm_limit)
+        return wait
+
+
+class KeyScheduler(object):
+    """
+    Pick the key with the most headroom of its requests-per-minute and tokens-per-minute budgets.
+    Failing keys are quarantined with exponential backoff and jitter, Retry-After is honoured when given.
+    It is thread-safe, and can be shared across processes by start_key_scheduler_server.
+    """
+
+    def __init__(
+            self,
+            keys: List[str],
+            rpm_limit: int = 3500,
+            tpm_limit: int = 90000,
+            base_backoff: float = 1.,
+            max_backoff: float = 60.
+    ):
+        assert len(keys) > 0, "No openai api key is given"
+        self.keys = list(keys)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._states = {key: _KeyState(rpm_limit, tpm_limit) for key in self.keys}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # A pickled copy schedules on its own, share a proxy of start_key_scheduler_server instead to coordinate.
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_args(args, keys: List[str]) -> 'KeyScheduler':
+        return KeyScheduler(
+            keys=keys,
+            rpm_limit=getattr(args, 'key_rpm_limit', 3500) if args else 3500,
+            tpm_limit=getattr(args, 'key_tpm_limit', 90000) if args else 90000
+        )
+
+    def acquire(self, n_tokens: int = 0) -> str:
+        """
+        Block until some key could serve a request of about n_tokens, reserve the budget and return the key.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                best_key, best_headroom, min_wait = None, None, None
+                for key, state in self._states.items():
+                    state.refill(now)
+                    wait = state.seconds_until_ready(n_tokens, now)
+                    if wait > 0:
+                        min_wait = wait if min_wait is None else min(min_wait, wait)
+                        continue
+                    if best_key is None or state.headroom() > best_headroom:
+                        best_key, best_headroom = key, state.headroom()
+                if best_key is not None:
+                    state = self._states[best_key]
+                    state.request_budget -= 1
+                    state.token_budget -= n_tokens
+                    return best_key
+            time.sleep(min_wait)
+
+    def report_success(self, key: str, n_tokens_reserved: int = 0, n_tokens_used: int = None):
+        """
+        Reset the failures of the key, and give back the reserved tokens not used.
+        """
+        with self._lock:
+            state = self._states[key]
+            state.n_failures = 0
+            if n_tokens_used is not None:
+                state.token_budget = min(state.tpm_limit, state.token_budget + n_tokens_reserved - n_tokens_used)
+
+    def report_failure(self, key: str, retry_after: float = None):
+        """
+        Quarantine the key for retry_after seconds if given, else by exponential backoff with jitter.
+        """
+        with self._lock:
+            state = self._states[key]
+            state.n_failures += 1
+            if retry_after is None:
+                backoff = min(self.max_backoff, self.base_backoff * 2 ** (state.n_failures - 1))
+                retry_after = backoff / 2 + random.uniform(0, backoff / 2)
+            state.quarantine_until = max(state.quarantine_until, time.time() + retry_after)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            now = time.time()
+            return {
+                key[:8] + '...': {
+                    'headroom': round(state.headroom(), 3),
+                    'n_failures': state.n_failures,
+                    'quarantined_seconds': round(max(0., state.quarantine_until - now), 1)
+                } for key, state in self._states.items()
+            }
+
+
+class KeySchedulerManager(BaseManager):
+    pass
+
+
+KeySchedulerManager.register('KeyScheduler', KeyScheduler)
+
+
+def start_key_scheduler_server(args, keys: List[str]):
+    """
+    Start a server process owning one KeyScheduler, return the manager and the scheduler proxy.
+    The proxy is picklable, pass it to the multiprocessing workers to coordinate the keys among them.
+    """
+    manager = KeySchedulerManager()
+    manager.start()
+    key_scheduler = manager.KeyScheduler(
+        keys=keys,
+        rpm_limit=args.key_rpm_limit,
+        tpm_limit=args.key_tpm_limit
+    )
+    return manager, key_scheduler
@@ -14,7 +14,7 @@ from utils.errors import DuplicateColumnsError
 from utils.mmqa.image_stuff import get_caption_map
 from retrieval.retrieve_pool import QAItem
 
-from utils.normalizer import prepare_df_for_neuraldb_from_table
+from utils.table_store import get_table_store
 
 
 def _create_table_prompt(df: pd.DataFrame, title: str):
@@ -108,7 +108,7 @@ class PromptBuilder(object):
             for passage in passages:
                 _header.append(passage['title'])
                 _rows[0].append(passage['text'])
-            passage_table = prepare_df_for_neuraldb_from_table({"header": _header, "rows": _rows})
+            passage_table = get_table_store().prepare_df_for_neuraldb_from_table({"header": _header, "rows": _rows})
             passage_table_prompt += _create_table_prompt(passage_table, "Passages")
             if not only_title:
                 passage_table_prompt += self._select_x_prompt(
@@ -140,7 +140,7 @@ class PromptBuilder(object):
             for image in images:
                 _header.append(image['title'])
                 _rows[0].append(image['caption'])
-            image_table = prepare_df_for_neuraldb_from_table({"header": _header, "rows": _rows})
+            image_table = get_table_store().prepare_df_for_neuraldb_from_table({"header": _header, "rows": _rows})
             image_table_prompt += _create_table_prompt(image_table, "Images")
             if not only_title:
                 image_table_prompt += self._select_x_prompt(
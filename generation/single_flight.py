@@ -0,0 +1,62 @@
+"""
+Coalesce identical calls in flight into one.
+"""
+
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+
+class SingleFlight(object):
+    """
+    When a call with the same key is already outstanding, later callers wait on its future
+    instead of making the call again.
+    """
+
+    def __init__(self):
+        self.n_calls = 0
+        self.n_coalesced = 0
+        self._in_flight: Dict[str, Future] = dict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Calls in flight only make sense in the current process.
+        return {'n_calls': self.n_calls, 'n_coalesced': self.n_coalesced}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key: str, func: Callable, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) unless the call of the key is in flight, in which case share its result.
+        """
+        with self._lock:
+            self.n_calls += 1
+            future = self._in_flight.get(key, None)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.n_coalesced += 1
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def stats(self) -> Dict:
+        return {
+            'n_calls': self.n_calls,
+            'n_coalesced': self.n_coalesced
+        }
@@ -1,13 +1,12 @@
 import copy
 import os
 import sqlite3
-import records
-import sqlalchemy
 import pandas as pd
 from typing import Dict, List
 import uuid
 
-from utils.normalizer import convert_df_type, prepare_df_for_neuraldb_from_table
+from utils.normalizer import convert_df_type
+from utils.table_store import get_table_store
 from utils.mmqa.image_stuff import get_caption
 
 
@@ -25,7 +24,7 @@ def check_in_and_return(key: str, source: dict):
 
 
 class NeuralDB(object):
-    def __init__(self, tables: List[Dict[str, Dict]], passages=None, images=None):
+    def __init__(self, tables: List[Dict[str, Dict]], passages=None, images=None, tmp_path=None):
         self.raw_tables = copy.deepcopy(tables)
         self.passages = {}
         self.images = {}
@@ -74,15 +73,18 @@ class NeuralDB(object):
                     self.image_linker[linked_cell] = title
 
         for table_info in tables:
-            table_info['table'] = prepare_df_for_neuraldb_from_table(table_info['table'])
+            table_info['table'] = get_table_store().prepare_df_for_neuraldb_from_table(table_info['table'])
 
         self.tables = tables
 
-        # Connect to SQLite database
-        self.tmp_path = "tmp"
-        os.makedirs(self.tmp_path, exist_ok=True)
-        # self.db_path = os.path.join(self.tmp_path, '{}.db'.format(hash(time.time())))
-        self.db_path = os.path.join(self.tmp_path, '{}.db'.format(uuid.uuid4()))
+        # Connect to SQLite database, in memory unless a directory is given to keep the db file for debugging
+        self.tmp_path = tmp_path
+        if self.tmp_path:
+            os.makedirs(self.tmp_path, exist_ok=True)
+            # self.db_path = os.path.join(self.tmp_path, '{}.db'.format(hash(time.time())))
+            self.db_path = os.path.join(self.tmp_path, '{}.db'.format(uuid.uuid4()))
+        else:
+            self.db_path = ":memory:"
         self.sqlite_conn = sqlite3.connect(self.db_path)
 
         # Create DB
@@ -95,9 +97,36 @@ class NeuralDB(object):
             self.table_name = "w"
             self.table_title = table_0.get('title', None)
 
-        # Records conn
-        self.db = records.Database('sqlite:///{}'.format(self.db_path))
-        self.records_conn = self.db.get_connection()
+        # Headers of the tables by PRAGMA table_info, dropped when add_sub_table changes the table
+        self._headers = {}
+
+    def clone(self):
+        """
+        A copy of this db with its own sqlite connection, made by the sqlite backup api without normalizing
+        the table again. The copy can add_sub_table freely, while this one stays pristine for the next copies.
+        """
+        db = copy.copy(self)
+        if self.tmp_path:
+            db.db_path = os.path.join(self.tmp_path, '{}.db'.format(uuid.uuid4()))
+        db.sqlite_conn = sqlite3.connect(db.db_path)
+        self.sqlite_conn.backup(db.sqlite_conn)
+        db._headers = dict(self._headers)
+        return db
+
+    def close(self):
+        """
+        Release the connections, the in-memory db is gone with them.
+        """
+        if self.sqlite_conn is None:
+            return
+        self.sqlite_conn.close()
+        self.sqlite_conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def __str__(self):
         return str(self.execute_query("SELECT * FROM {}".format(self.table_name)))
@@ -109,8 +138,11 @@ class NeuralDB(object):
         return _table
 
     def get_header(self, table_name=None):
-        _table = self.get_table(table_name)
-        return _table['header']
+        table_name = self.table_name if not table_name else table_name
+        if table_name not in self._headers:
+            self._headers[table_name] = [column[1] for column in
+                                         self.sqlite_conn.execute("PRAGMA table_info({})".format(table_name))]
+        return list(self._headers[table_name])
 
     def get_rows(self, table_name):
         _table = self.get_table(table_name)
@@ -146,10 +178,11 @@ class NeuralDB(object):
     def get_passage_linker(self):
         return copy.deepcopy(self.passage_linker)
 
-    def execute_query(self, sql_query: str):
+    def execute_query(self, sql_query: str, column_major=False):
         """
         Basic operation. Execute the sql query on the database we hold.
         @param sql_query:
+        @param column_major: return the values by columns as {"header", "columns"} instead of {"header", "rows"}.
         @return:
         """
         # When the sql query is a column name (@deprecated: or a certain value with '' and "" surrounded).
@@ -158,29 +191,28 @@ class NeuralDB(object):
             new_sql_query = r"SELECT row_id, {} FROM {}".format(col_name, self.table_name)
             # Here we use a hack that when a value is surrounded by '' or "", the sql will return a column of the value,
             # while for variable, no ''/"" surrounded, this sql will query for the column.
-            out = self.records_conn.query(new_sql_query)
+            cursor = self.sqlite_conn.execute(new_sql_query)
         # When the sql query wants all cols or col_id, which is no need for us to add 'row_id'.
         elif sql_query.lower().startswith("select *") or sql_query.startswith("select col_id"):
-            out = self.records_conn.query(sql_query)
+            cursor = self.sqlite_conn.execute(sql_query)
         else:
             try:
                 # SELECT row_id in addition, needed for result and old table alignment.
                 new_sql_query = "SELECT row_id, " + sql_query[7:]
-                out = self.records_conn.query(new_sql_query)
-            except sqlalchemy.exc.OperationalError as e:
+                cursor = self.sqlite_conn.execute(new_sql_query)
+            except sqlite3.OperationalError as e:
                 # Execute normal SQL, and in this case the row_id is actually in no need.
-                out = self.records_conn.query(sql_query)
-
-        results = out.all()
-        unmerged_results = []
-        merged_results = []
-
-        headers = out.dataset.headers
-        for i in range(len(results)):
-            unmerged_results.append(list(results[i].values()))
-            merged_results.extend(results[i].values())
-
-        return {"header": headers, "rows": unmerged_results}
+                cursor = self.sqlite_conn.execute(sql_query)
+
+        # Plain sqlite3 cursor, no Record objects built for each row
+        rows = cursor.fetchall()
+        # As records did, the header of an empty result is None, which the executor and the voting rely on
+        headers = [column[0] for column in cursor.description] if rows else None
+        cursor.close()
+        if column_major:
+            columns = [list(column) for column in zip(*rows)]
+            return {"header": headers, "columns": columns}
+        return {"header": headers, "rows": [list(row) for row in rows]}
 
     def add_sub_table(self, sub_table, table_name=None, verbose=True):
         """
@@ -197,6 +229,7 @@ class NeuralDB(object):
                                     how='left', on='row_id')  # do left join
         new_table.to_sql(table_name, self.sqlite_conn, if_exists='replace',
                          index=False)
+        self._headers.pop(table_name, None)
         if verbose:
             print("Insert column(s) {} (dtypes: {}) into table.\n".format(', '.join([_ for _ in sub_table['header']]),
                                                                           sub_table_df_normed.dtypes))
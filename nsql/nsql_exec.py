@@ -1,4 +1,7 @@
-from typing import List, Dict
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
 from nsql.qa_module.openai_qa import OpenAIQAModel
 from nsql.qa_module.vqa import vqa_call
 from nsql.database import NeuralDB
@@ -7,9 +10,14 @@ from nsql.parser import get_cfg_tree, get_steps, remove_duplicate, TreeNode, par
 
 
 class Executor(object):
-    def __init__(self, args, keys=None):
+    def __init__(self, args, keys=None, key_scheduler=None, gateway=None):
         self.new_col_name_id = 0
-        self.qa_model = OpenAIQAModel(args, keys)
+        self.qa_model = OpenAIQAModel(args, keys, key_scheduler=key_scheduler, gateway=gateway)
+        # Run the independent QA steps of a program concurrently, wave by wave of the tree
+        self.qa_dag = not getattr(args, 'disable_qa_dag', False)
+        self.qa_dag_workers = getattr(args, 'qa_dag_workers', 8)
+        # Created here rather than on the first wave, concurrent first waves would each create a pool
+        self._thread_pool = ThreadPoolExecutor(max_workers=self.qa_dag_workers)
 
     def generate_new_col_names(self, number):
         col_names = ["col_{}".format(i) for i in range(self.new_col_name_id, self.new_col_name_id + number)]
@@ -22,6 +30,127 @@ class Executor(object):
         result = db.execute_query(sql)
         return result
 
+    @staticmethod
+    def _step_question(step: TreeNode):
+        # The question is the first quoted string of the QA clause, nested QA clauses come after it
+        all_quote_idx = [i.start() for i in re.finditer('\"', step.name)]
+        return step.name[all_quote_idx[0] + 1: all_quote_idx[1]]
+
+    @staticmethod
+    def _height(tree_node: TreeNode):
+        if not tree_node.children:
+            return 0
+        return 1 + max([Executor._height(child) for child in tree_node.children])
+
+    def _get_waves(self, steps: List[TreeNode]):
+        """
+        Group the steps into waves by their heights in the tree, the steps of one wave depend on no one in it.
+        The steps are kept in the post order inside a wave.
+        """
+        if not self.qa_dag:
+            return [[step] for step in steps]
+        heights = [Executor._height(step) for step in steps]
+        return [[step for step, height in zip(steps, heights) if height == wave_height]
+                for wave_height in sorted(set(heights))]
+
+    def _prepare_qa_step(self, step: TreeNode, db: NeuralDB, verbose=True):
+        """
+        Execute the parameters of the QA step on the db, return the question and the sub-tables to ask on.
+        """
+        nsql = step.rename
+        question, sql_s = parse_question_paras(nsql, self.qa_model)
+        sql_executed_sub_tables = []
+
+        # Execute all SQLs and get the results as parameters
+        for sql_item in sql_s:
+            role, sql_item = nsql_role_recognize(sql_item,
+                                                 db.get_header(),
+                                                 db.get_passages_titles(),
+                                                 db.get_images_titles())
+            if role in ['col', 'complete_sql']:
+                sql_executed_sub_table = self.sql_exec(sql_item, db, verbose=verbose)
+                sql_executed_sub_tables.append(sql_executed_sub_table)
+            elif role == 'val':
+                val = eval(sql_item)
+                sql_executed_sub_tables.append({
+                    "header": ["row_id", "val"],
+                    "rows": [["0", val]]
+                })
+            elif role == 'passage_title_and_image_title':
+                sql_executed_sub_tables.append({
+                    "header": ["row_id", "{}".format(sql_item)],
+                    "rows": [["0", db.get_passage_by_title(sql_item) +
+                              db.get_image_caption_by_title(sql_item)
+                              # "{} (The answer of '{}' is {})".format(
+                              #     sql_item,
+                              #     # Add image qa result as backup info
+                              #     question[len("***@"):],
+                              #     vqa_call(question=question[len("***@"):],
+                              #              image_path=db.get_image_by_title(sql_item)))
+                              ]]
+                })
+            elif role == 'passage_title':
+                sql_executed_sub_tables.append({
+                    "header": ["row_id", "{}".format(sql_item)],
+                    "rows": [["0", db.get_passage_by_title(sql_item)]]
+                })
+            elif role == 'image_title':
+                sql_executed_sub_tables.append({
+                    "header": ["row_id", "{}".format(sql_item)],
+                    "rows": [["0", db.get_image_caption_by_title(sql_item)]],
+                    # "rows": [["0", "{} (The answer of '{}' is {})".format(
+                    #         sql_item,
+                    #         # Add image qa result as backup info
+                    #         question[len("***@"):],
+                    #         vqa_call(question=question[len("***@"):],
+                    #                  image_path=db.get_image_by_title(sql_item)))]],
+                })
+
+        # If the sub_tables to execute with link, append it to the cell.
+        passage_linker = db.get_passage_linker()
+        image_linker = db.get_image_linker()
+        for _sql_executed_sub_table in sql_executed_sub_tables:
+            for i in range(len(_sql_executed_sub_table['rows'])):
+                for j in range(len(_sql_executed_sub_table['rows'][i])):
+                    _cell = _sql_executed_sub_table['rows'][i][j]
+                    if _cell in passage_linker.keys():
+                        _sql_executed_sub_table['rows'][i][j] += " ({})".format(
+                            # Add passage text as backup info
+                            db.get_passage_by_title(passage_linker[_cell]))
+
+                    if _cell in image_linker.keys():
+                        _sql_executed_sub_table['rows'][i][j] += " ({})".format(
+                            # Add image caption as backup info
+                            db.get_image_caption_by_title(image_linker[_cell]))
+                        # _sql_executed_sub_table['rows'][i][j] += " (The answer of '{}' is {})".format(
+                        #     # Add image qa result as backup info
+                        #     question[len("***@"):],
+                        #     vqa_call(question=question[len("***@"):],
+                        #              image_path=db.get_image_by_title(image_linker[_cell])))
+                        pass
+
+        return question, sql_executed_sub_tables
+
+    def _ask_qa_step(self, question: str, sql_executed_sub_tables: List, db: NeuralDB, new_col_name_s: List,
+                     verbose=True):
+        if question.lower().startswith("map@"):
+            return self.qa_model.qa(question[len("map@"):],
+                                    sql_executed_sub_tables,
+                                    table_title=db.table_title,
+                                    qa_type="map",
+                                    new_col_name_s=new_col_name_s,
+                                    verbose=verbose)
+        elif question.lower().startswith("ans@"):
+            return self.qa_model.qa(question[len("ans@"):],
+                                    sql_executed_sub_tables,
+                                    table_title=db.table_title,
+                                    qa_type="ans",
+                                    verbose=verbose)
+        else:
+            raise ValueError(
+                "Except for operators or NL question must start with 'map@' or 'ans@'!, check '{}'".format(
+                    question))
+
     def nsql_exec(self, nsql: str, db: NeuralDB, verbose=True):
         steps = []
         root_node = get_cfg_tree(nsql)  # Parse execution tree from nsql.
@@ -29,122 +158,45 @@ class Executor(object):
         steps = remove_duplicate(steps)  # Remove the duplicate steps.
         if verbose:
             print("Steps:", [s.rename for s in steps])
+
+        # Name the produced columns in the post order, the same whether the steps run one by one or in waves
         col_idx = 0
         for step in steps:
+            if step.name.startswith('QA(') and self._step_question(step).lower().startswith("map@"):
+                if step.father:
+                    step.rename_father_col(col_idx=col_idx)
+                    col_idx += 1
+                else:  # This step is the final step
+                    step.produced_col_name_s = ["col_{}".format(col_idx)]
+
+        for wave in self._get_waves(steps):
             # All steps should be formatted as 'QA()' except for last step which could also be normal SQL.
-            assert isinstance(step, TreeNode), "step must be treenode"
-            nsql = step.rename
-            if nsql.startswith('QA('):
-                question, sql_s = parse_question_paras(nsql, self.qa_model)
-                sql_executed_sub_tables = []
-
-                # Execute all SQLs and get the results as parameters
-                for sql_item in sql_s:
-                    role, sql_item = nsql_role_recognize(sql_item,
-                                                         db.get_header(),
-                                                         db.get_passages_titles(),
-                                                         db.get_images_titles())
-                    if role in ['col', 'complete_sql']:
-                        sql_executed_sub_table = self.sql_exec(sql_item, db, verbose=verbose)
-                        sql_executed_sub_tables.append(sql_executed_sub_table)
-                    elif role == 'val':
-                        val = eval(sql_item)
-                        sql_executed_sub_tables.append({
-                            "header": ["row_id", "val"],
-                            "rows": [["0", val]]
-                        })
-                    elif role == 'passage_title_and_image_title':
-                        sql_executed_sub_tables.append({
-                            "header": ["row_id", "{}".format(sql_item)],
-                            "rows": [["0", db.get_passage_by_title(sql_item) +
-                                      db.get_image_caption_by_title(sql_item)
-                                      # "{} (The answer of '{}' is {})".format(
-                                      #     sql_item,
-                                      #     # Add image qa result as backup info
-                                      #     question[len("***@"):],
-                                      #     vqa_call(question=question[len("***@"):],
-                                      #              image_path=db.get_image_by_title(sql_item)))
-                                      ]]
-                        })
-                    elif role == 'passage_title':
-                        sql_executed_sub_tables.append({
-                            "header": ["row_id", "{}".format(sql_item)],
-                            "rows": [["0", db.get_passage_by_title(sql_item)]]
-                        })
-                    elif role == 'image_title':
-                        sql_executed_sub_tables.append({
-                            "header": ["row_id", "{}".format(sql_item)],
-                            "rows": [["0", db.get_image_caption_by_title(sql_item)]],
-                            # "rows": [["0", "{} (The answer of '{}' is {})".format(
-                            #         sql_item,
-                            #         # Add image qa result as backup info
-                            #         question[len("***@"):],
-                            #         vqa_call(question=question[len("***@"):],
-                            #                  image_path=db.get_image_by_title(sql_item)))]],
-                        })
-
-                # If the sub_tables to execute with link, append it to the cell.
-                passage_linker = db.get_passage_linker()
-                image_linker = db.get_image_linker()
-                for _sql_executed_sub_table in sql_executed_sub_tables:
-                    for i in range(len(_sql_executed_sub_table['rows'])):
-                        for j in range(len(_sql_executed_sub_table['rows'][i])):
-                            _cell = _sql_executed_sub_table['rows'][i][j]
-                            if _cell in passage_linker.keys():
-                                _sql_executed_sub_table['rows'][i][j] += " ({})".format(
-                                    # Add passage text as backup info
-                                    db.get_passage_by_title(passage_linker[_cell]))
-
-                            if _cell in image_linker.keys():
-                                _sql_executed_sub_table['rows'][i][j] += " ({})".format(
-                                    # Add image caption as backup info
-                                    db.get_image_caption_by_title(image_linker[_cell]))
-                                # _sql_executed_sub_table['rows'][i][j] += " (The answer of '{}' is {})".format(
-                                #     # Add image qa result as backup info
-                                #     question[len("***@"):],
-                                #     vqa_call(question=question[len("***@"):],
-                                #              image_path=db.get_image_by_title(image_linker[_cell])))
-                                pass
+            for step in wave:
+                assert isinstance(step, TreeNode), "step must be treenode"
+            if not wave[0].rename.startswith('QA('):
+                sub_table = self.sql_exec(wave[0].rename, db, verbose=verbose)
+                return extract_answers(sub_table)
+
+            # The db is read and written in this thread, only the QA calls of the independent steps run concurrently
+            asked = [self._prepare_qa_step(step, db, verbose=verbose) for step in wave]
+            if len(wave) == 1:
+                results = [self._ask_qa_step(*asked[0], db, wave[0].produced_col_name_s, verbose=verbose)]
+            else:
+                futures = [self._thread_pool.submit(self._ask_qa_step, question, sub_tables, db,
+                                                          step.produced_col_name_s, verbose=verbose)
+                           for step, (question, sub_tables) in zip(wave, asked)]
+                results = [future.result() for future in futures]
 
+            for step, (question, _), result in zip(wave, asked, results):
                 if question.lower().startswith("map@"):
                     # When the question is a type of mapping, we return the mapped column.
-                    question = question[len("map@"):]
                     if step.father:
-                        step.rename_father_col(col_idx=col_idx)
-                        sub_table: Dict = self.qa_model.qa(question,
-                                                           sql_executed_sub_tables,
-                                                           table_title=db.table_title,
-                                                           qa_type="map",
-                                                           new_col_name_s=step.produced_col_name_s,
-                                                           verbose=verbose)
-                        db.add_sub_table(sub_table, verbose=verbose)
-                        col_idx += 1
+                        db.add_sub_table(result, verbose=verbose)
                     else:  # This step is the final step
-                        sub_table: Dict = self.qa_model.qa(question,
-                                                           sql_executed_sub_tables,
-                                                           table_title=db.table_title,
-                                                           qa_type="map",
-                                                           new_col_name_s=["col_{}".format(col_idx)],
-                                                           verbose=verbose)
-                        return extract_answers(sub_table)
-
-                elif question.lower().startswith("ans@"):
+                        return extract_answers(result)
+                else:
                     # When the question is a type of answering, we return an answer list.
-                    question = question[len("ans@"):]
-                    answer: List = self.qa_model.qa(question,
-                                                    sql_executed_sub_tables,
-                                                    table_title=db.table_title,
-                                                    qa_type="ans",
-                                                    verbose=verbose)
                     if step.father:
-                        step.rename_father_val(answer)
+                        step.rename_father_val(result)
                     else:  # This step is the final step
-                        return answer
-                else:
-                    raise ValueError(
-                        "Except for operators or NL question must start with 'map@' or 'ans@'!, check '{}'".format(
-                            question))
-
-            else:
-                sub_table = self.sql_exec(nsql, db, verbose=verbose)
-                return extract_answers(sub_table)
+                        return result
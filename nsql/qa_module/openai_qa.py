@@ -1,20 +1,34 @@
+import asyncio
 import os
 import random
+import threading
+from collections import OrderedDict
 
 from generation.prompt import OpenAIQAPromptBuilder
 from generation.generator import Generator
+from generation.cache import CompletionCache
+from nsql.qa_module.qa_batcher import QABatcher
+from nsql.qa_module.qa_cache import QAMemo, CellAnswerCache
 from retrieval.retriever import OpenAIQARetriever
-from retrieval.retrieve_pool import OpenAIQARetrievePool, QAItem
+from retrieval.retrieve_pool import QAItem, load_qa_retrieve_pool
+from utils.errors import CassetteMissError
+from utils.utils import count_tokens
 
 num_parallel_prompts = 10
 num_qa_shots = 8
 infinite_rows_len = 50  # If the table contain rows larger than this number, it will be handled rows by rows.
 max_tokens = 1024
+engine_context_tokens = {
+    "gpt-3.5-turbo": 4096, "gpt-3.5-turbo-0613": 4096, "gpt-3.5-turbo-16k": 16384, "gpt-3.5-turbo-16k-0613": 16384,
+    "gpt-4": 8192, "gpt-4-0613": 8192, "code-davinci-002": 8001, "text-davinci-003": 4097
+}
+map_answer_tokens = 8  # Estimated output tokens of the answer to one row
+token_budget_margin = 0.9  # Token counts are of the GPT-2 tokenizer, leave some room for the tokenizer of the engine
 ROOT_DIR = os.path.join(os.path.dirname(__file__), "../../")
 
 
 class OpenAIQAModel(object):
-    def __init__(self, args, keys=None):
+    def __init__(self, args, keys=None, key_scheduler=None, gateway=None):
         super().__init__()
 
         # Prepare keys
@@ -23,41 +37,108 @@ class OpenAIQAModel(object):
         random.seed(42)
         random.shuffle(self.keys)
 
-        retrieve_pool = OpenAIQARetrievePool(
-            data_path=os.path.join(ROOT_DIR, args.qa_retrieve_pool_file)
+        retrieve_pool = load_qa_retrieve_pool(
+            data_path=os.path.normpath(os.path.join(ROOT_DIR, args.qa_retrieve_pool_file))
         )
         self.retriever = OpenAIQARetriever(retrieve_pool)
         self.engine = args.engine
-        self.generator = Generator(args=None, keys=self.keys)  # Just to use its call api function
+        # fixme: hard code for now, fix later
+        self.is_chat = self.engine in ["gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-0613",
+                                       "gpt-3.5-turbo-16k-0613",
+                                       "gpt-4", "gpt-4-0613"]
+        # Just to use its call api function, and share the completion cache with the nsql generation
+        self.generator = Generator(args=None, keys=self.keys, cache=CompletionCache.from_args(args),
+                                   key_scheduler=key_scheduler, gateway=gateway, llm_args=args)
+        # Batch the QA prompts of the examples executed concurrently in a worker, on the generator above
+        self.qa_batcher = QABatcher.from_args(args, self.generator) \
+            if getattr(args, 'n_threads_per_process', 1) > 1 and getattr(args, 'qa_batch_size', 1) > 1 else None
 
         self.prompting_method = 'new_db'
         self.answer_split_token: str = ';'
         self.db_mapping_token = "\t"
+        # Stream the map@ completions and stop as soon as all the rows are mapped
+        self.stream_map = getattr(args, 'qa_stream_map', False)
+        # Times to retry a map@ chunk failed, or the rows missed in its output
+        self.map_max_retries = getattr(args, 'qa_map_max_retries', 2)
+        # Chunk the map@ rows by token budget, or by infinite_rows_len rows
+        self.map_chunking = getattr(args, 'qa_map_chunking', 'tokens')
+        self.context_tokens = getattr(args, 'qa_context_tokens', None) or engine_context_tokens.get(self.engine, 4096)
+        # Collapse the map@ rows to the distinct input tuples
+        self.map_dedup = not getattr(args, 'disable_qa_map_dedup', False)
+        self.map_stats = {'n_calls': 0, 'n_rows': 0, 'n_distinct_rows': 0, 'n_sent_rows': 0,
+                          'n_misaligned_rows': 0, 'n_recovered_rows': 0}
+        # The QA steps of a wave run in threads sharing this model
+        self._map_stats_lock = threading.Lock()
+        self.memo = None if getattr(args, 'disable_qa_memo', False) else QAMemo.from_args(args)
+        # Map@ answers of each cell tuple, reused across tables
+        self.cell_cache = CellAnswerCache.from_args(args) if getattr(args, 'qa_cell_cache', False) else None
 
-    def call_openai_api_completion(self, prompt):
-        completion = self.generator._call_openai_api(engine=self.engine,
-                                                     prompt=prompt,
-                                                     max_tokens=max_tokens,
-                                                     temperature=0,
-                                                     top_p=1,
-                                                     n=1,
-                                                     stop=["\n\n"])
-        return completion
+    def stats(self):
+        with self._map_stats_lock:
+            map_stats = dict(self.map_stats)
+        return {
+            'map_calls': map_stats['n_calls'],
+            'map_rows': map_stats['n_rows'],
+            'map_distinct_rows': map_stats['n_distinct_rows'],
+            'map_sent_rows': map_stats['n_sent_rows'],
+            'map_rows_per_call': round(map_stats['n_sent_rows'] / max(map_stats['n_calls'], 1), 2),
+            'map_misaligned_rows': map_stats['n_misaligned_rows'],
+            'map_recovered_rows': map_stats['n_recovered_rows'],
+            'memo': self.memo.stats() if self.memo else None,
+            'cell_cache': self.cell_cache.stats() if self.cell_cache else None,
+            'batcher': self.qa_batcher.stats() if self.qa_batcher else None
+        }
 
-    def call_openai_for_completion_text(self, prompt, openai_usage_type="completion"):
-        if openai_usage_type == "completion":
-            completion = self.call_openai_api_completion(prompt)
+    def _add_map_stats(self, **counts):
+        with self._map_stats_lock:
+            for name, count in counts.items():
+                self.map_stats[name] += count
+
+    def _request_args(self, prompt, stream_map_rows=None, stream_map_header=None, sample_round=None):
+        return dict(engine=self.engine,
+                    prompt=prompt,
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    top_p=1,
+                    n=1,
+                    stop=["\n\n"],
+                    is_chat=self.is_chat,
+                    sample_round=sample_round,
+                    stream_map_rows=stream_map_rows,
+                    stream_map_header=stream_map_header,
+                    stream_map_token=self.db_mapping_token if stream_map_rows is not None else None)
 
-            # fixme: hard code for now, fix later
-            is_chat = self.engine in ["gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-3.5-turbo-0613",
-                                      "gpt-3.5-turbo-16k-0613",
-                                      "gpt-4", "gpt-4-0613"]
+    def call_openai_api_completion(self, prompt, stream_map_rows=None, stream_map_header=None, sample_round=None):
+        request_args = self._request_args(prompt, stream_map_rows=stream_map_rows,
+                                          stream_map_header=stream_map_header, sample_round=sample_round)
+        if self.qa_batcher:
+            return self.qa_batcher.submit(request_args).result()
+        completion = self.generator._call_openai_api(**request_args)
+        return completion
+
+    def _completion_text(self, completion):
+        text = completion['choices'][0]['message']['content'] if self.is_chat else completion['choices'][0]['text']
+        return text
 
-            text = completion['choices'][0]['message']['content'] if is_chat else completion['choices'][0]['text']
-            return text
+    def call_openai_for_completion_text(self, prompt, openai_usage_type="completion", stream_map_rows=None,
+                                        stream_map_header=None):
+        if openai_usage_type == "completion":
+            completion = self.call_openai_api_completion(prompt, stream_map_rows=stream_map_rows,
+                                                         stream_map_header=stream_map_header)
+            return self._completion_text(completion)
         else:
             raise ValueError("The model usage type '{}' doesn't exists!".format(openai_usage_type))
 
+    async def acall_openai_for_completion_text(self, prompt, stream_map_rows=None, stream_map_header=None,
+                                               sample_round=None):
+        request_args = self._request_args(prompt, stream_map_rows=stream_map_rows,
+                                          stream_map_header=stream_map_header, sample_round=sample_round)
+        if self.qa_batcher:
+            completion = await asyncio.wrap_future(self.qa_batcher.submit(request_args))
+        else:
+            completion = await self.generator._acall_openai_api(**request_args)
+        return self._completion_text(completion)
+
     @staticmethod
     def merge_tables(tables, by='row_id'):
         assert len(set([len(_table['rows']) for _table in tables])) == 1, "Tables must have the same rows!"
@@ -78,15 +159,19 @@ class OpenAIQAModel(object):
                     merged_rows[i].append(row[col_idx])
         return {"header": merged_header, "rows": merged_rows}
 
-    def wrap_with_prompt_for_table_qa(self,
-                                      question,
-                                      sub_table,
-                                      table_title=None,
-                                      answer_split_token=None,
-                                      qa_type="ans",
-                                      prompting_method="new_db",
-                                      db_mapping_token="😅",
-                                      verbose=True):
+    def build_few_shot_prompt_for_table_qa(self,
+                                           question,
+                                           sub_table,
+                                           table_title=None,
+                                           answer_split_token=None,
+                                           qa_type="ans",
+                                           prompting_method="new_db",
+                                           db_mapping_token="😅",
+                                           verbose=True):
+        """
+        The prompt before the table, with the shots retrieved by the question and the header of the sub-table.
+        It doesn't depend on the rows, so the chunks of one map@ QA share it.
+        """
         prompt = "Question Answering Over Database:\n\n"
         if qa_type in ['map', 'ans'] and num_qa_shots > 0:
             query_item = QAItem(qa_question=question, table=sub_table, title=table_title)
@@ -103,6 +188,28 @@ class OpenAIQAModel(object):
                 few_shot_prompt_list.append(one_shot_prompt)
             few_shot_prompt = '\n'.join(few_shot_prompt_list[:num_qa_shots])
             prompt = few_shot_prompt
+        return prompt
+
+    def wrap_with_prompt_for_table_qa(self,
+                                      question,
+                                      sub_table,
+                                      table_title=None,
+                                      answer_split_token=None,
+                                      qa_type="ans",
+                                      prompting_method="new_db",
+                                      db_mapping_token="😅",
+                                      verbose=True,
+                                      few_shot_prompt=None):
+        if few_shot_prompt is None:
+            few_shot_prompt = self.build_few_shot_prompt_for_table_qa(question,
+                                                                      sub_table,
+                                                                      table_title,
+                                                                      answer_split_token,
+                                                                      qa_type,
+                                                                      prompting_method=prompting_method,
+                                                                      db_mapping_token=db_mapping_token,
+                                                                      verbose=verbose)
+        prompt = few_shot_prompt
 
         prompt += "\nGive a database as shown below:\n{}\n\n".format(
             OpenAIQAPromptBuilder.table2codex_prompt(sub_table, table_title)
@@ -130,17 +237,105 @@ class OpenAIQAModel(object):
 
         return prompt
 
+    def chunk_rows_by_tokens(self, question, table, table_title=None, few_shot_prompt=None):
+        """
+        Split the rows into chunks, each packing as many rows as the prompt and the output budgets allow.
+        The prompt is the few-shot prefix(the same for every chunk) plus the rows serialized by table2codex_prompt,
+        and it leaves max_tokens for the output, which in new_db style copies each row and appends the answer.
+        """
+        empty_prompt = self.wrap_with_prompt_for_table_qa(question,
+                                                          {"header": table['header'], "rows": []},
+                                                          table_title,
+                                                          self.answer_split_token,
+                                                          "map",
+                                                          prompting_method=self.prompting_method,
+                                                          db_mapping_token=self.db_mapping_token,
+                                                          verbose=False,
+                                                          few_shot_prompt=few_shot_prompt)
+        header_tokens = count_tokens(OpenAIQAPromptBuilder.table2codex_prompt(
+            {"header": table['header'], "rows": []}))
+        prompt_budget = int((self.context_tokens - max_tokens) * token_budget_margin) - count_tokens(empty_prompt)
+        output_budget = int(max_tokens * token_budget_margin) - (
+            header_tokens + map_answer_tokens if self.prompting_method == "new_db" else 0)
+
+        chunks, chunk, prompt_tokens, output_tokens = [], [], 0, 0
+        drop_row_id = table['header'][0] == "row_id"
+        for row in table['rows']:
+            row_tokens = count_tokens("\t".join([str(cell) for cell in (row[1:] if drop_row_id else row)]) + "\n")
+            row_output_tokens = row_tokens + map_answer_tokens if self.prompting_method == "new_db" \
+                else map_answer_tokens
+            if chunk and (prompt_tokens + row_tokens > prompt_budget or
+                          output_tokens + row_output_tokens > output_budget):
+                chunks.append(chunk)
+                chunk, prompt_tokens, output_tokens = [], 0, 0
+            chunk.append(row)
+            prompt_tokens += row_tokens
+            output_tokens += row_output_tokens
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def parse_map_output(self, completion_str, table):
+        """
+        Parse the map@ output in new_db style, where each line copies the cells of a row and appends the answer.
+        Lines are anchored to the rows by the copied cells, so the rows dropped or merged by the model are
+        left None instead of shifting the answers of the rest rows.
+        """
+        lines = completion_str.split("\n")[2:-1]
+        drop_row_id = table['header'][0] == "row_id"
+        row_ids_of_cells = dict()
+        for i, row in enumerate(table['rows']):
+            cells = self.db_mapping_token.join([str(cell) for cell in (row[1:] if drop_row_id else row)])
+            row_ids_of_cells.setdefault(cells.lower().strip(), []).append(i)
+
+        answers = [None] * len(table['rows'])
+        for line in lines:
+            if self.db_mapping_token not in line:
+                continue
+            cells, answer = line.rsplit(self.db_mapping_token, 1)
+            row_ids = row_ids_of_cells.get(cells.strip(), [])
+            if row_ids:
+                answers[row_ids.pop(0)] = answer
+
+        if all(answer is None for answer in answers) and len(lines) == len(table['rows']):
+            # No line anchored, the model reformatted the cells but kept one line per row, align by position as before.
+            # When some lines anchored, the rest rows are dropped or duplicated ones, left None to be asked again.
+            return [line.split(self.db_mapping_token)[-1] for line in lines]
+        return answers
+
     def qa(self, question, sub_tables, qa_type: str, verbose: bool = True, **args):
         # If it is not a problem API can handle, answer it with a QA model.
         merged_table = OpenAIQAModel.merge_tables(sub_tables)
         if verbose:
             print("Make Question {} on {}".format(question, merged_table))
+
+        # The same sub-question on the same sub-table is asked only once, e.g., by the programs sampled for one question
+        memo_key = QAMemo.key(self.engine, question, qa_type, merged_table, args.get('table_title', None)) \
+            if self.memo else None
+        memo_value = self.memo.get(memo_key) if self.memo else None
+        if memo_value is not None:
+            if verbose:
+                print("QA {}@ answered by memo: {}".format(qa_type, memo_value))
+            if qa_type == "map":
+                return {"header": ['row_id'] + args['new_col_name_s'], "rows": memo_value}
+            return memo_value
+
         if qa_type == "map":
             # Map: col(s) -question> one col
 
+            # Retrieve the shots once, the chunks and the retries differ only in rows
+            few_shot_prompt = self.build_few_shot_prompt_for_table_qa(question,
+                                                                      {"header": merged_table['header'], "rows": []},
+                                                                      args['table_title'],
+                                                                      self.answer_split_token,
+                                                                      qa_type,
+                                                                      prompting_method=self.prompting_method,
+                                                                      db_mapping_token=self.db_mapping_token,
+                                                                      verbose=verbose)
+
             # Make model make a QA towards a sub-table
             # col(s) -> one col, all QA in one time
-            def do_map(_table):
+            async def ado_map(_table, attempt=0, is_missing_rows=False):
                 _prompt = self.wrap_with_prompt_for_table_qa(question,
                                                              _table,
                                                              args['table_title'],
@@ -148,8 +343,29 @@ class OpenAIQAModel(object):
                                                              qa_type,
                                                              prompting_method=self.prompting_method,
                                                              db_mapping_token=self.db_mapping_token,
-                                                             verbose=verbose)
-                completion_str = self.call_openai_for_completion_text(_prompt).lower().strip(' []')
+                                                             verbose=verbose,
+                                                             few_shot_prompt=few_shot_prompt)
+                stream_map_rows, stream_map_header = None, None
+                if self.stream_map and self.prompting_method == "new_db":
+                    # The output copies the header line of the prompt, which drops row_id
+                    stream_map_rows = len(_table['rows'])
+                    stream_map_header = "\t".join(_table['header'][1:] if _table['header'][0] == "row_id"
+                                                   else _table['header'])
+                try:
+                    # Retries are told apart by sample_round to not get the same failed completion from cache
+                    completion_str = (await self.acall_openai_for_completion_text(
+                        _prompt,
+                        stream_map_rows=stream_map_rows,
+                        stream_map_header=stream_map_header,
+                        sample_round=attempt if attempt > 0 else None
+                    )).lower().strip(' []')
+                except CassetteMissError:
+                    raise
+                except Exception as e:
+                    if attempt == self.map_max_retries:
+                        raise
+                    print(f"QA map@ chunk failed: {e}, retry.")
+                    return await ado_map(_table, attempt + 1, is_missing_rows)
 
                 if verbose:
                     print(f'QA map@ input:\n{_prompt}')
@@ -158,34 +374,104 @@ class OpenAIQAModel(object):
                 if self.prompting_method == "basic":
                     answers = [_answer.strip(" '").lower() for _answer in
                                completion_str.split(self.answer_split_token)]
+                    answers = answers[:len(_table['rows'])] + [None] * (len(_table['rows']) - len(answers))
                 elif self.prompting_method == "new_db":
-                    answers = [line.split(self.db_mapping_token)[-1] for line in completion_str.split("\n")[2:-1]]
+                    answers = self.parse_map_output(completion_str, _table)
                 else:
                     raise ValueError("No such prompting methods: '{}'! ".format(self.prompting_method))
+
+                # Ask again only for the rows dropped or merged by the model
+                missing_row_ids = [i for i, answer in enumerate(answers) if answer is None]
+                if missing_row_ids and not is_missing_rows:
+                    # The rows asked again were already counted when they were missed first
+                    self._add_map_stats(n_misaligned_rows=len(missing_row_ids))
+                if missing_row_ids and attempt < self.map_max_retries:
+                    print(f"QA map@ chunk missed {len(missing_row_ids)} of {len(_table['rows'])} rows, retry them.")
+                    missing_answers = await ado_map({
+                        "header": _table['header'],
+                        "rows": [_table['rows'][i] for i in missing_row_ids]
+                    }, attempt + 1, is_missing_rows=True)
+                    for i, answer in zip(missing_row_ids, missing_answers):
+                        if answer is not None:
+                            answers[i] = answer
+                            self._add_map_stats(n_recovered_rows=1)
                 return answers
 
+            async def ado_map_chunks(_tables):
+                # All the chunks are in flight together, bounded by the concurrency limit of the generator
+                return await asyncio.gather(*[ado_map(_table) for _table in _tables])
+
+            # Ask once per distinct input tuple, and broadcast the answers back to every row_id later
+            if self.map_dedup:
+                distinct_rows = OrderedDict()
+                for row in merged_table['rows']:
+                    distinct_rows.setdefault(tuple(row[1:]), row)
+                map_table = {"header": merged_table['header'], "rows": list(distinct_rows.values())}
+            else:
+                map_table = merged_table
+            self._add_map_stats(n_distinct_rows=len(map_table['rows']))
+
+            # Only the rows not answered by the cell cache are sent to the model
+            cell_answers = dict()
+            if self.cell_cache:
+                for row in map_table['rows']:
+                    answer = self.cell_cache.get(CellAnswerCache.key(self.engine, question, row[1:]))
+                    if answer is not None:
+                        cell_answers[tuple(row[1:])] = answer
+            query_table = {"header": map_table['header'],
+                           "rows": [row for row in map_table['rows'] if tuple(row[1:]) not in cell_answers]}
+
             # Handle infinite rows, rows by rows.
+            if not query_table['rows']:
+                tables = []
+            elif self.map_chunking == 'tokens':
+                tables = [{"header": query_table['header'], "rows": rows}
+                          for rows in self.chunk_rows_by_tokens(question, query_table, args['table_title'],
+                                                                few_shot_prompt)]
+            else:
+                rows_len = len(query_table['rows'])
+                run_times = int(rows_len / infinite_rows_len) if rows_len % infinite_rows_len == 0 else int(
+                    rows_len / infinite_rows_len) + 1
+
+                tables = []
+                for run_idx in range(run_times):
+                    _table = {
+                        "header": query_table['header'],
+                        "rows": query_table['rows'][run_idx * infinite_rows_len:]
+                    } if run_idx == run_times - 1 else \
+                        {
+                            "header": query_table['header'],
+                            "rows": query_table['rows'][run_idx * infinite_rows_len:(run_idx + 1) * infinite_rows_len]
+                        }
+                    tables.append(_table)
+            self._add_map_stats(n_calls=len(tables), n_rows=len(merged_table['rows']),
+                                n_sent_rows=len(query_table['rows']))
+            print("QA map@ {} rows({} distinct, {} from cell cache) in {} calls, {:.1f} rows per call.".format(
+                len(merged_table['rows']), len(map_table['rows']), len(map_table['rows']) - len(query_table['rows']),
+                len(tables), len(query_table['rows']) / max(len(tables), 1)))
+
             answers = []
-            rows_len = len(merged_table['rows'])
-            run_times = int(rows_len / infinite_rows_len) if rows_len % infinite_rows_len == 0 else int(
-                rows_len / infinite_rows_len) + 1
-
-            for run_idx in range(run_times):
-                _table = {
-                    "header": merged_table['header'],
-                    "rows": merged_table['rows'][run_idx * infinite_rows_len:]
-                } if run_idx == run_times - 1 else \
-                    {
-                        "header": merged_table['header'],
-                        "rows": merged_table['rows'][run_idx * infinite_rows_len:(run_idx + 1) * infinite_rows_len]
-                    }
-
-                answers.extend(do_map(_table))
+            for chunk_answers in asyncio.run(ado_map_chunks(tables)):
+                # Each chunk gives an answer or None for each of its rows, so the later chunks are kept aligned
+                answers.extend(chunk_answers)
+            if self.cell_cache:
+                for row, answer in zip(query_table['rows'], answers):
+                    if answer is not None:
+                        self.cell_cache.put(CellAnswerCache.key(self.engine, question, row[1:]), answer)
+                query_answers = iter(answers)
+                answers = [cell_answers[tuple(row[1:])] if tuple(row[1:]) in cell_answers else next(query_answers)
+                           for row in map_table['rows']]
             if verbose:
                 print("The map@ openai answers are {}".format(answers))
-            # Add row_id in addition for finding to corresponding rows.
+            if self.map_dedup:
+                tuple_answers = {tuple(row[1:]): answer for row, answer in zip(map_table['rows'], answers)}
+                answers = [tuple_answers[tuple(row[1:])] for row in merged_table['rows']]
+            # Add row_id in addition for finding to corresponding rows, rows not answered are left to the left join.
+            rows = [[row[0], answer] for row, answer in zip(merged_table['rows'], answers) if answer is not None]
+            if self.memo:
+                self.memo.put(memo_key, rows)
             return {"header": ['row_id'] + args['new_col_name_s'],
-                    "rows": [[row[0], answer] for row, answer in zip(merged_table['rows'], answers)]}
+                    "rows": rows}
         elif qa_type == "ans":
             # Ans: col(s) -question> answer
             prompt = self.wrap_with_prompt_for_table_qa(question,
@@ -199,6 +485,8 @@ class OpenAIQAModel(object):
                 print(f'QA ans@ input:\n{prompt}')
                 print(f'QA ans@ output:\n{answers}')
 
+            if self.memo:
+                self.memo.put(memo_key, answers)
             return answers
         else:
             raise ValueError("Please choose from map and ans in the qa usage!!")
@@ -0,0 +1,103 @@
+"""
+Micro-batching of QA prompts from concurrent executions into shared api calls.
+"""
+
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+from generation.generator import Generator
+
+
+class QABatcher(object):
+    """
+    Collect the QA prompts submitted by the concurrent executions of a worker, for up to window_seconds
+    or max_batch_size prompts, and send the prompts sharing the same request params in one Generator call.
+    The generator packs them into multi-prompt requests for non-chat engines(completion_batch_size > 1),
+    or sends them as a concurrent burst otherwise. Each caller gets the completion of its own prompt.
+    """
+
+    def __init__(
+            self,
+            generator: Generator,
+            window_seconds: float = 0.02,
+            max_batch_size: int = 16,
+            max_concurrent_batches: int = 4
+    ):
+        self.generator = generator
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.n_prompts = 0
+        self.n_batches = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._dispatch_pool = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+
+    @staticmethod
+    def from_args(args, generator: Generator) -> 'QABatcher':
+        return QABatcher(
+            generator=generator,
+            window_seconds=getattr(args, 'qa_batch_window', 0.02),
+            max_batch_size=getattr(args, 'qa_batch_size', 16)
+        )
+
+    def submit(self, request_args: Dict) -> Future:
+        """
+        Queue the args of Generator._call_openai_api of one prompt, the future resolves to its completion.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((request_args, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.window_seconds
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # Only the prompts with the same request params can share one call
+            groups = OrderedDict()
+            for request_args, future in batch:
+                params = {k: v for k, v in request_args.items() if k != 'prompt'}
+                groups.setdefault(repr(sorted(params.items())), []).append((request_args, future))
+            for items in groups.values():
+                self._dispatch_pool.submit(self._dispatch, items)
+
+    def _dispatch(self, items: List):
+        with self._lock:
+            self.n_prompts += len(items)
+            self.n_batches += 1
+        request_args = dict(items[0][0])
+        request_args['prompt'] = [item_request_args['prompt'] for item_request_args, _ in items]
+        try:
+            completion = self.generator._call_openai_api(**request_args)
+            # One choice per prompt as n is 1 for QA
+            for (_, future), choice in zip(items, completion['choices']):
+                future.set_result({"choices": [choice]})
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'prompts': self.n_prompts,
+                'batches': self.n_batches,
+                'prompts_per_batch': round(self.n_prompts / max(self.n_batches, 1), 2)
+            }
@@ -0,0 +1,126 @@
+"""
+Memo of QA results shared by the programs executed on the same table.
+"""
+
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from generation.cache import CompletionCache, request_key
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r'\s+', ' ', question.strip().lower())
+
+
+class QAMemo(object):
+    """
+    Map the (normalized question, qa_type, content of the merged sub-table) to the QA result.
+    Results are kept in an in-memory LRU for the lifetime of the process, and optionally persisted
+    in a table of a CompletionCache file to reuse across runs.
+    """
+
+    def __init__(self, max_entries: int = 10000, cache: CompletionCache = None):
+        self.max_entries = max_entries
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_args(args) -> 'QAMemo':
+        cache_file = getattr(args, 'qa_cache_file', None)
+        return QAMemo(
+            max_entries=getattr(args, 'qa_memo_max_entries', 10000),
+            cache=CompletionCache(
+                db_path=cache_file,
+                max_entries=getattr(args, 'completion_cache_max_entries', 100000),
+                table_name='qa_results'
+            ) if cache_file else None
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(engine: str, question: str, qa_type: str, table: Dict, table_title: str = None) -> str:
+        return request_key({
+            "engine": engine,
+            "question": normalize_question(question),
+            "qa_type": qa_type,
+            "table_title": table_title,
+            "table": table
+        })
+
+    def get(self, key: str) -> Optional[List]:
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return json.loads(self._memo[key])
+        value = self.cache.get(key) if self.cache else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._put_memo(key, value)
+        return value
+
+    def put(self, key: str, value: List):
+        with self._lock:
+            self._put_memo(key, value)
+        if self.cache:
+            self.cache.put(key, value)
+
+    def _put_memo(self, key: str, value: List):
+        # Store the json string, so the callers never share and mutate the same lists
+        self._memo[key] = json.dumps(value, ensure_ascii=False)
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.max_entries:
+            self._memo.popitem(last=False)
+
+    def stats(self) -> Dict:
+        n_queries = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_queries if n_queries else 0.
+        }
+
+
+class CellAnswerCache(QAMemo):
+    """
+    Map@ answers of single rows, keyed by the (normalized question, input cell tuple) only.
+    Row-wise questions like "what is the year?" are pure functions of the cells, so the answers are reused
+    across tables. The header is left out of the key on purpose, to also match the tables naming columns differently.
+    """
+
+    @staticmethod
+    def from_args(args) -> 'CellAnswerCache':
+        cache_file = getattr(args, 'qa_cache_file', None)
+        return CellAnswerCache(
+            max_entries=getattr(args, 'qa_cell_cache_max_entries', 1000000),
+            cache=CompletionCache(
+                db_path=cache_file,
+                max_entries=getattr(args, 'completion_cache_max_entries', 100000),
+                table_name='qa_cell_answers'
+            ) if cache_file else None
+        )
+
+    @staticmethod
+    def key(engine: str, question: str, cells: List) -> str:
+        return request_key({
+            "engine": engine,
+            "question": normalize_question(question),
+            "cells": [str(cell) for cell in cells]
+        })
@@ -2,6 +2,7 @@
 Retrieval pool of candidates
 """
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import List, Dict
 import json
 
@@ -27,7 +28,8 @@ class OpenAIQARetrievePool(object):
         self.pointer = 0
 
     def __iter__(self):
-        return self
+        # A fresh iterator each time, the pool is shared by the threads of a process
+        return iter(self.data)
 
     def __next__(self):
         pointer = self.pointer
@@ -45,6 +47,14 @@ class OpenAIQARetrievePool(object):
         return len(self.data)
 
 
+@lru_cache(maxsize=None)
+def load_qa_retrieve_pool(data_path) -> OpenAIQARetrievePool:
+    """
+    Load the retrieve pool once per process, and share it by all the QA models.
+    """
+    return OpenAIQARetrievePool(data_path=data_path)
+
+
 @dataclass
 class QAItem(object):
     id: int = None
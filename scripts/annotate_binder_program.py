@@ -13,8 +13,14 @@ import platform
 import multiprocessing
 
 from generation.generator import Generator
+from generation.adaptive_sampler import AdaptiveSampler
+from generation.key_scheduler import start_key_scheduler_server
+from generation.gateway import start_llm_gateway_server
+from utils.errors import CassetteMissError
 from utils.utils import load_data_split
+from utils.table_store import set_table_store_dir
 from nsql.database import NeuralDB
+from nsql.nsql_exec import Executor
 
 ROOT_DIR = os.path.join(os.path.dirname(__file__), "../")
 
@@ -30,8 +36,31 @@ def worker_annotate(
     """
     A worker process for annotating.
     """
+    set_table_store_dir(args.table_store_dir)
     g_dict = dict()
     built_few_shot_prompts = []
+
+    # Sample in rounds and stop early once the vote of executed programs is decided
+    sampler = None
+    if args.adaptive_sampling:
+        executor = Executor(args, generator.keys, key_scheduler=generator.key_scheduler, gateway=generator.gateway)
+        sampler = AdaptiveSampler(args, generator, executor)
+
+    def generate_one_pass(prompts):
+        if sampler is None:
+            return generator.generate_one_pass(
+                prompts=prompts,
+                verbose=args.verbose
+            )
+        response_dict, stats_dict = sampler.generate_one_pass(
+            prompts=prompts,
+            data_items={eid: g_dict[eid]['ori_data_item'] for eid, _ in prompts},
+            verbose=args.verbose
+        )
+        for eid, stats in stats_dict.items():
+            g_dict[eid]['adaptive_sampling'] = stats
+        return response_dict
+
     for g_eid in g_eids:
         try:
             g_data_item = dataset[g_eid]
@@ -39,11 +68,11 @@ def worker_annotate(
                 'generations': [],
                 'ori_data_item': copy.deepcopy(g_data_item)
             }
-            db = NeuralDB(
-                tables=[{'title': g_data_item['table']['page_title'], 'table': g_data_item['table']}]
-            )
-            g_data_item['table'] = db.get_table_df()
-            g_data_item['title'] = db.get_table_title()
+            with NeuralDB(
+                    tables=[{'title': g_data_item['table']['page_title'], 'table': g_data_item['table']}]
+            ) as db:
+                g_data_item['table'] = db.get_table_df()
+                g_data_item['title'] = db.get_table_title()
             n_shots = args.n_shots
             few_shot_prompt = generator.build_few_shot_prompt_from_file(
                 file_path=args.prompt_file,
@@ -72,15 +101,14 @@ def worker_annotate(
                 continue
 
             print(f"Process#{pid}: Prompts ready with {len(built_few_shot_prompts)} parallels. Run openai API.")
-            response_dict = generator.generate_one_pass(
-                prompts=built_few_shot_prompts,
-                verbose=args.verbose
-            )
+            response_dict = generate_one_pass(built_few_shot_prompts)
             for eid, g_pairs in response_dict.items():
                 g_pairs = sorted(g_pairs, key=lambda x: x[-1], reverse=True)
                 g_dict[eid]['generations'] = g_pairs
 
             built_few_shot_prompts = []
+        except CassetteMissError:
+            raise
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -88,14 +116,13 @@ def worker_annotate(
 
     # Final generation inference
     if len(built_few_shot_prompts) > 0:
-        response_dict = generator.generate_one_pass(
-            prompts=built_few_shot_prompts,
-            verbose=args.verbose
-        )
+        response_dict = generate_one_pass(built_few_shot_prompts)
         for eid, g_pairs in response_dict.items():
             g_pairs = sorted(g_pairs, key=lambda x: x[-1], reverse=True)
             g_dict[eid]['generations'] = g_pairs
 
+    print(f"Process#{pid}: Generator stats: {generator.stats()}")
+
     return g_dict
 
 
@@ -105,6 +132,17 @@ def main():
     args.prompt_file = os.path.join(ROOT_DIR, args.prompt_file)
     args.save_dir = os.path.join(ROOT_DIR, args.save_dir)
     os.makedirs(args.save_dir, exist_ok=True)
+    if args.adaptive_sampling:
+        assert args.sampling_round_n > 0
+    if args.completion_cache_file:
+        args.completion_cache_file = os.path.join(ROOT_DIR, args.completion_cache_file)
+    if args.llm_cassette_file:
+        args.llm_cassette_file = os.path.join(ROOT_DIR, args.llm_cassette_file)
+    if args.qa_cache_file:
+        args.qa_cache_file = os.path.join(ROOT_DIR, args.qa_cache_file)
+    if args.table_store_dir:
+        args.table_store_dir = os.path.join(ROOT_DIR, args.table_store_dir)
+    set_table_store_dir(args.table_store_dir)
 
     # Load dataset
     start_time = time.time()
@@ -121,8 +159,13 @@ def main():
     with open(args.api_keys_file, 'r') as f:
         keys = [line.strip() for line in f.readlines()]
 
-    # Annotate
-    generator = Generator(args, keys=keys)
+    # Annotate, with the keys scheduled among all the processes or all the requests sent through one gateway process
+    key_scheduler, gateway = None, None
+    if args.llm_gateway:
+        manager, gateway = start_llm_gateway_server(args, keys)
+    else:
+        manager, key_scheduler = start_key_scheduler_server(args, keys)
+    generator = Generator(args, keys=keys, key_scheduler=key_scheduler, gateway=gateway)
     generate_eids = list(range(len(dataset)))
     generate_eids_group = [[] for _ in range(args.n_processes)]
     for g_eid in generate_eids:
@@ -149,6 +192,8 @@ def main():
         g_dict.update(worker_g_dict)
     pool.close()
     pool.join()
+    print(f'LLM gateway stats: {gateway.stats()}' if gateway else f'Key scheduler stats: {key_scheduler.stats()}')
+    manager.shutdown()
 
     # Save annotation results
     # "_".join(["{}={}".format(k, str(args.__dict__[k])) for k in args.__dict__ if k not in ['api_keys_file', 'prompt_file', 'save_dir', 'stop_tokens']])
@@ -193,6 +238,44 @@ if __name__ == '__main__':
     # Codex options
     parser.add_argument('--engine', type=str, default="gpt-3.5-turbo")
     parser.add_argument('--n_parallel_prompts', type=int, default=1)
+    parser.add_argument('--llm_mode', type=str, default='live', choices=['live', 'record', 'replay'],
+                        help='Call the api live, record the requests and responses, or replay them from the cassette.')
+    parser.add_argument('--llm_cassette_file', type=str, default=None,
+                        help='Append-only jsonl file of the recorded requests and responses.')
+    parser.add_argument('--api_base', type=str, default=None,
+                        help='Base url of an openai-compatible server, e.g., the one of scripts/openai_stub_server.py.')
+    parser.add_argument('--max_concurrent_requests', type=int, default=8,
+                        help='Max number of in-flight api requests per process.')
+    parser.add_argument('--completion_batch_size', type=int, default=1,
+                        help='Max number of prompts packed into one call for non-chat engines.')
+    parser.add_argument('--completion_batch_max_tokens', type=int, default=32000,
+                        help='Max prompt plus generation tokens of one batched call.')
+    parser.add_argument('--key_rpm_limit', type=int, default=3500,
+                        help='Requests per minute allowed for each api key.')
+    parser.add_argument('--key_tpm_limit', type=int, default=90000,
+                        help='Tokens per minute allowed for each api key.')
+    parser.add_argument('--llm_gateway', action='store_true',
+                        help='Whether send the api requests of all processes through one local gateway process.')
+    parser.add_argument('--qa_stream_map', action='store_true',
+                        help='Whether stream the map@ QA completions and stop once all the rows are mapped.')
+    parser.add_argument('--qa_map_max_retries', type=int, default=2,
+                        help='Times to retry a map@ QA chunk failed, or the rows missed in its output.')
+    parser.add_argument('--qa_map_chunking', type=str, default='tokens', choices=['tokens', 'rows'],
+                        help='Pack map@ QA rows into calls by token budget, or by fixed 50 rows.')
+    parser.add_argument('--qa_context_tokens', type=int, default=None,
+                        help='Context window of the QA engine, looked up by the engine name if not set.')
+    parser.add_argument('--disable_qa_map_dedup', action='store_true',
+                        help='Whether ask map@ QA on every row instead of once per distinct row.')
+    parser.add_argument('--disable_qa_memo', action='store_true',
+                        help='Whether ask the same QA on the same sub-table again instead of reusing the result.')
+    parser.add_argument('--qa_cache_file', type=str, default=None,
+                        help='SQLite file to persist the QA results across runs, in memory only if not set.')
+    parser.add_argument('--qa_cell_cache', action='store_true',
+                        help='Whether reuse the map@ QA answers of the same cells across tables.')
+    parser.add_argument('--disable_qa_dag', action='store_true',
+                        help='Whether run the QA steps of a program one by one instead of the independent ones together.')
+    parser.add_argument('--qa_dag_workers', type=int, default=8,
+                        help='Max number of independent QA steps of a program running at the same time.')
     parser.add_argument('--max_generation_tokens', type=int, default=256)
     parser.add_argument('--max_api_total_tokens', type=int, default=3800)
     parser.add_argument('--temperature', type=float, default=0.4)
@@ -200,6 +283,34 @@ if __name__ == '__main__':
     parser.add_argument('--top_p', type=float, default=1.0)
     parser.add_argument('--stop_tokens', type=str, default='\n\n',
                         help='Split stop tokens by ||')
+    parser.add_argument('--completion_cache_file', type=str, default=None,
+                        help='SQLite file to cache api completions across runs, no cache if not set.')
+    parser.add_argument('--completion_cache_max_entries', type=int, default=100000)
+    parser.add_argument('--table_store_dir', type=str, default=None,
+                        help='Directory to persist the normalized tables across runs, in memory only if not set.')
+
+    # Adaptive sampling options
+    parser.add_argument('--adaptive_sampling', action='store_true',
+                        help='Whether sample in rounds and stop once the majority vote of executions is decided.')
+    parser.add_argument('--sampling_round_n', type=int, default=5,
+                        help='Number of programs sampled per round in adaptive sampling.')
+    parser.add_argument('--sampling_confidence', type=float, default=None,
+                        help='Also stop when the leading answer has this share of votes, no threshold if not set.')
+    parser.add_argument('--sampling_min_n', type=int, default=10,
+                        help='Min number of programs sampled before the confidence threshold applies.')
+    parser.add_argument('--qa_retrieve_pool_file', type=str, default='templates/qa_retrieve_pool/qa_retrieve_pool.json')
+    parser.add_argument('--process_program_with_fuzzy_match_on_db', action='store_false',
+                        help='Whether use fuzzy match with db and program to improve on program.')
+    parser.add_argument('--allow_none_and_empty_answer', action='store_true',
+                        help='Whether regarding none and empty executions as a valid answer.')
+    parser.add_argument('--answer_placeholder', type=int, default=0,
+                        help='Placeholder answer if execution error occurs.')
+    parser.add_argument('--vote_method', type=str, default='simple',
+                        choices=['simple', 'prob', 'answer_biased'])
+    parser.add_argument('--answer_biased', type=int, default=None,
+                        help='The answer to be biased w. answer_biased_weight in majority vote.')
+    parser.add_argument('--answer_biased_weight', type=float, default=None,
+                        help='The weight of the answer to be biased in majority vote.')
 
     # debug options
     parser.add_argument('-v', '--verbose', action='store_false')
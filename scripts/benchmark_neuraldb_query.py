@@ -0,0 +1,87 @@
+"""
+Microbenchmark of NeuralDB.execute_query on large tables, against the former records/SQLAlchemy path.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+import records
+from sqlalchemy.pool import StaticPool
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "../")
+sys.path.insert(0, ROOT_DIR)
+
+from nsql.database import NeuralDB
+
+
+def records_execute_query(records_conn, sql_query: str):
+    """
+    The former execute_query body for a full SELECT, Record objects and the two copies of the rows.
+    """
+    out = records_conn.query(sql_query)
+    results = out.all()
+    unmerged_results = []
+    merged_results = []
+    headers = out.dataset.headers
+    for i in range(len(results)):
+        unmerged_results.append(list(results[i].values()))
+        merged_results.extend(results[i].values())
+    return {"header": headers, "rows": unmerged_results}
+
+
+def build_db(n_rows: int, n_cols: int):
+    """
+    A NeuralDB holding a synthetic table of n_rows x n_cols, written straight to sqlite to skip the normalization.
+    """
+    db = NeuralDB([{"title": "benchmark", "table": {"header": ["c0"], "rows": [["0"]]}}])
+    df = pd.DataFrame({
+        "row_id": list(range(n_rows)),
+        **{"c{}".format(j): ["cell {} {}".format(i, j) if j % 2 else i * j for i in range(n_rows)]
+           for j in range(n_cols)}
+    })
+    df.to_sql(db.table_name, db.sqlite_conn, if_exists='replace')
+    return db
+
+
+def timeit(fn, n_repeats: int):
+    start_time = time.time()
+    for _ in range(n_repeats):
+        result = fn()
+    return (time.time() - start_time) / n_repeats, result
+
+
+def main():
+    for n_rows in args.n_rows:
+        db = build_db(n_rows, args.n_cols)
+        records_db = records.Database('sqlite://', creator=lambda: db.sqlite_conn, poolclass=StaticPool)
+        records_conn = records_db.get_connection()
+        for sql_query in ["SELECT * FROM w", "SELECT c1, c2 FROM w WHERE c2 > 10",
+                          "SELECT c1 FROM w WHERE c2 < 0", "`c1`"]:
+            records_sql_query = sql_query
+            if sql_query.startswith('`'):
+                records_sql_query = "SELECT row_id, {} FROM w".format(sql_query)
+            elif not sql_query.lower().startswith("select *"):
+                records_sql_query = "SELECT row_id, " + sql_query[7:]
+            records_time, records_result = timeit(
+                lambda: records_execute_query(records_conn, records_sql_query), args.n_repeats)
+            raw_time, raw_result = timeit(lambda: db.execute_query(sql_query), args.n_repeats)
+            column_major_time, _ = timeit(lambda: db.execute_query(sql_query, column_major=True), args.n_repeats)
+            assert records_result['header'] == raw_result['header'] and records_result['rows'] == raw_result['rows']
+            print(f"{n_rows} rows, {sql_query}: records {records_time * 1000:.2f}ms, "
+                  f"sqlite3 {raw_time * 1000:.2f}ms({records_time / raw_time:.1f}x), "
+                  f"column major {column_major_time * 1000:.2f}ms")
+        records_conn.close()
+        records_db.close()
+        db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_rows', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--n_cols', type=int, default=10)
+    parser.add_argument('--n_repeats', type=int, default=5)
+    args = parser.parse_args()
+    main()
@@ -7,11 +7,16 @@ import argparse
 import platform, multiprocessing
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from nsql.nsql_exec import Executor, NeuralDB
+from generation.key_scheduler import start_key_scheduler_server
+from generation.gateway import start_llm_gateway_server
 from utils.normalizer import post_process_sql
-from utils.utils import load_data_split, majority_vote
+from utils.errors import CassetteMissError
+from utils.utils import load_data_split, majority_vote, majority_vote_is_decided
 from utils.evaluator import Evaluator
+from utils.table_store import set_table_store_dir
 
 ROOT_DIR = os.path.join(os.path.dirname(__file__), "../")
 
@@ -21,84 +26,148 @@ def worker_execute(
         args,
         dataset,
         nsql_dict,
-        keys
+        keys,
+        key_scheduler=None,
+        gateway=None
 ):
     """
     A worker process for execution.
     """
+    set_table_store_dir(args.table_store_dir)
     result_dict = dict()
     n_total_samples, n_correct_samples = 0, 0
-    for eid, data_item in enumerate(dataset):
-        eid = str(eid)
-        if eid not in nsql_dict:
-            continue
+    n_total_programs, n_skipped_programs = 0, 0
+    # Build the executor(with the QA model, its retrieve pool, caches and QA batcher) once, and share it by all
+    # the examples running in n_threads_per_process threads
+    setup_start_time = time.time()
+    executor = Executor(args, keys, key_scheduler=key_scheduler, gateway=gateway)
+    setup_time = time.time() - setup_start_time
+    db_build_times, db_clone_times = [], []
+
+    def execute_example(eid, data_item):
         print(f"Process#{pid}: eid {eid}, wtq-id {data_item['id']}")
-        result_dict[eid] = dict()
-        result_dict[eid]['question'] = data_item['question']
-        result_dict[eid]['gold_answer'] = data_item['answer_text']
-        n_total_samples += 1
+        example_result = dict()
+        example_result['question'] = data_item['question']
+        example_result['gold_answer'] = data_item['answer_text']
         table = data_item['table']
         title = table['page_title']
-        executor = Executor(args, keys)
         # Execute
-        exec_answer_list = []
-        nsql_exec_answer_dict = dict()
-        for idx, (nsql, logprob) in enumerate(nsql_dict[eid]['nsqls']):
-            print(f"Process#{pid}: eid {eid}, original_id {data_item['id']}, executing program#{idx}, logprob={logprob}")
-            try:
-                if nsql in nsql_exec_answer_dict:
-                    exec_answer = nsql_exec_answer_dict[nsql]
-                else:
-                    db = NeuralDB(
-                        tables=[{"title": title, "table": table}]
-                    )
-                    nsql = post_process_sql(
-                        sql_str=nsql,
-                        df=db.get_table_df(),
-                        process_program_with_fuzzy_match_on_db=args.process_program_with_fuzzy_match_on_db,
-                        table_title=title
-                    )
-                    exec_answer = executor.nsql_exec(nsql, db, verbose=args.verbose)
-                    if isinstance(exec_answer, str):
-                        exec_answer = [exec_answer]
-                    nsql_exec_answer_dict[nsql] = exec_answer
-                exec_answer_list.append(exec_answer)
-            except Exception as e:
-                print(f"Process#{pid}: Execution error {e}")
-                exec_answer = '<error>'
-                exec_answer_list.append(exec_answer)
-            # Store tmp execution answers
-            if nsql_dict[eid].get('exec_answers', None) is None:
-                nsql_dict[eid]['exec_answers'] = []
-            nsql_dict[eid]['exec_answers'].append(exec_answer)
-        # Majority vote to determine the final prediction answer
-        pred_answer, pred_answer_nsqls = majority_vote(
-            nsqls=nsql_dict[eid]['nsqls'],
-            pred_answer_list=exec_answer_list,
+        vote_kwargs = dict(
             allow_none_and_empty_answer=args.allow_none_and_empty_answer,
             answer_placeholder=args.answer_placeholder,
             vote_method=args.vote_method,
             answer_biased=args.answer_biased,
             answer_biased_weight=args.answer_biased_weight
         )
+        nsqls = nsql_dict[eid]['nsqls']
+        # Execute the likely programs first, and stop once the rest can no longer change the voted answer
+        exec_order = list(range(len(nsqls)))
+        if not args.disable_early_exit_vote:
+            exec_order = sorted(exec_order, key=lambda i: nsqls[i][1], reverse=True)
+        exec_answer_dict = dict()
+        nsql_exec_answer_dict = dict()
+        # Normalize the table once(at the first program executed, so a failure is an error vote as before),
+        # and give each program a clone of the db to add its sub-tables to
+        pristine_db = None
+        try:
+            for order_idx, idx in enumerate(exec_order):
+                nsql, logprob = nsqls[idx]
+                print(f"Process#{pid}: eid {eid}, original_id {data_item['id']}, "
+                      f"executing program#{idx}, logprob={logprob}")
+                try:
+                    if nsql in nsql_exec_answer_dict:
+                        exec_answer = nsql_exec_answer_dict[nsql]
+                    else:
+                        if pristine_db is None:
+                            setup_start = time.time()
+                            pristine_db = NeuralDB(
+                                tables=[{"title": title, "table": table}],
+                                tmp_path=args.neuraldb_tmp_dir
+                            )
+                            db_build_times.append(time.time() - setup_start)
+                        setup_start = time.time()
+                        with pristine_db.clone() as db:
+                            db_clone_times.append(time.time() - setup_start)
+                            nsql = post_process_sql(
+                                sql_str=nsql,
+                                df=db.get_table_df(),
+                                process_program_with_fuzzy_match_on_db=args.process_program_with_fuzzy_match_on_db,
+                                table_title=title
+                            )
+                            exec_answer = executor.nsql_exec(nsql, db, verbose=args.verbose)
+                        if isinstance(exec_answer, str):
+                            exec_answer = [exec_answer]
+                        nsql_exec_answer_dict[nsql] = exec_answer
+                except CassetteMissError:
+                    raise
+                except Exception as e:
+                    print(f"Process#{pid}: Execution error {e}")
+                    exec_answer = '<error>'
+                exec_answer_dict[idx] = exec_answer
+
+                remaining_nsqls = [nsqls[i] for i in exec_order[order_idx + 1:]]
+                if not args.disable_early_exit_vote and remaining_nsqls:
+                    executed_idx = sorted(exec_answer_dict.keys())
+                    if majority_vote_is_decided(
+                            nsqls=[nsqls[i] for i in executed_idx],
+                            pred_answer_list=[exec_answer_dict[i] for i in executed_idx],
+                            n_remaining=len(remaining_nsqls),
+                            remaining_nsqls=remaining_nsqls,
+                            **vote_kwargs
+                    ):
+                        print(f"Process#{pid}: eid {eid}, vote decided, "
+                              f"skip the rest {len(remaining_nsqls)} programs.")
+                        break
+        finally:
+            if pristine_db is not None:
+                pristine_db.close()
+        # Store tmp execution answers, aligned with the nsqls
+        nsql_dict[eid]['exec_answers'] = [exec_answer_dict.get(i, '<skipped>') for i in range(len(nsqls))]
+        n_skipped_programs = len(nsqls) - len(exec_answer_dict)
+        # Majority vote to determine the final prediction answer, over the executed programs in the original order
+        executed_idx = sorted(exec_answer_dict.keys())
+        pred_answer, pred_answer_nsqls = majority_vote(
+            nsqls=[nsqls[i] for i in executed_idx],
+            pred_answer_list=[exec_answer_dict[i] for i in executed_idx],
+            **vote_kwargs
+        )
         # Evaluate
-        result_dict[eid]['pred_answer'] = pred_answer
-        result_dict[eid]['nsql'] = pred_answer_nsqls
+        example_result['pred_answer'] = pred_answer
+        example_result['nsql'] = pred_answer_nsqls
         gold_answer = data_item['answer_text']
         score = Evaluator().evaluate(
             pred_answer,
             gold_answer,
             dataset=args.dataset,
-            question=result_dict[eid]['question']
+            question=example_result['question']
         )
-        n_correct_samples += score
-        print(f'Process#{pid}: pred answer: {pred_answer}')
-        print(f'Process#{pid}: gold answer: {gold_answer}')
-        if score == 1:
-            print(f'Process#{pid}: Correct!')
-        else:
-            print(f'Process#{pid}: Wrong.')
-        print(f'Process#{pid}: Accuracy: {n_correct_samples}/{n_total_samples}')
+        print(f'Process#{pid}: eid {eid} pred answer: {pred_answer}')
+        print(f'Process#{pid}: eid {eid} gold answer: {gold_answer}')
+        print(f'Process#{pid}: QA generator stats: {executor.qa_model.generator.stats()}')
+        print(f'Process#{pid}: QA stats: {executor.qa_model.stats()}')
+        return example_result, score, n_skipped_programs
+
+    examples = [(str(eid), data_item) for eid, data_item in enumerate(dataset) if str(eid) in nsql_dict]
+    with ThreadPoolExecutor(max_workers=args.n_threads_per_process) as pool:
+        # Results are consumed in the order of the examples
+        for (eid, _), (example_result, score, n_skipped) in zip(
+                examples, pool.map(lambda example: execute_example(*example), examples)):
+            result_dict[eid] = example_result
+            n_total_samples += 1
+            n_correct_samples += score
+            n_total_programs += len(nsql_dict[eid]['nsqls'])
+            n_skipped_programs += n_skipped
+            if score == 1:
+                print(f'Process#{pid}: eid {eid} Correct!')
+            else:
+                print(f'Process#{pid}: eid {eid} Wrong.')
+            print(f'Process#{pid}: Accuracy: {n_correct_samples}/{n_total_samples}')
+            print(f'Process#{pid}: Skipped programs by early exit vote: {n_skipped_programs}/{n_total_programs}')
+    print(f'Process#{pid}: Executor setup took {setup_time:.3f}s once, '
+          f'{setup_time / max(n_total_samples, 1):.4f}s per example over {n_total_samples} examples.')
+    print(f'Process#{pid}: NeuralDB setup took {sum(db_build_times) / max(len(db_build_times), 1):.4f}s per example, '
+          f'{sum(db_clone_times) / max(len(db_clone_times), 1):.4f}s per program(cloned) '
+          f'over {len(db_clone_times)} programs.')
 
         # Save tmp execution answers
     with open(os.path.join(args.save_dir, f"{pid}.json"), 'w') as f:
@@ -112,6 +181,15 @@ def main():
     args.api_keys_file = os.path.join(ROOT_DIR, args.api_keys_file)
     args.save_dir = os.path.join(ROOT_DIR, args.save_dir)
     os.makedirs(args.save_dir, exist_ok=True)
+    if args.completion_cache_file:
+        args.completion_cache_file = os.path.join(ROOT_DIR, args.completion_cache_file)
+    if args.llm_cassette_file:
+        args.llm_cassette_file = os.path.join(ROOT_DIR, args.llm_cassette_file)
+    if args.qa_cache_file:
+        args.qa_cache_file = os.path.join(ROOT_DIR, args.qa_cache_file)
+    if args.table_store_dir:
+        args.table_store_dir = os.path.join(ROOT_DIR, args.table_store_dir)
+    set_table_store_dir(args.table_store_dir)
 
     # Load dataset
     start_time = time.time()
@@ -144,6 +222,13 @@ def main():
     for idx, eid in enumerate(nsql_dict.keys()):
         nsql_dict_group[idx % args.n_processes][eid] = nsql_dict[eid]
 
+    # Schedule the keys among all the processes, or send all the requests through one gateway process
+    key_scheduler, gateway = None, None
+    if args.llm_gateway:
+        manager, gateway = start_llm_gateway_server(args, keys)
+    else:
+        manager, key_scheduler = start_key_scheduler_server(args, keys)
+
     # Execute programs
     result_dict = dict()
     worker_results = []
@@ -154,7 +239,9 @@ def main():
             args,
             dataset,
             nsql_dict_group[pid],
-            keys
+            keys,
+            key_scheduler,
+            gateway
         )))
 
     # Merge worker results
@@ -163,6 +250,8 @@ def main():
         result_dict.update(worker_result_dict)
     pool.close()
     pool.join()
+    print(f'LLM gateway stats: {gateway.stats()}' if gateway else f'Key scheduler stats: {key_scheduler.stats()}')
+    manager.shutdown()
     n_correct_samples = 0
     for eid, item in result_dict.items():
         pred_answer, gold_answer = item['pred_answer'], item['gold_answer']
@@ -201,11 +290,57 @@ if __name__ == '__main__':
 
     # Multiprocess options
     parser.add_argument('--n_processes', type=str, default=1)
+    parser.add_argument('--n_threads_per_process', type=int, default=1,
+                        help='Number of examples executed at the same time in each process.')
 
     # Execution options
     parser.add_argument('--engine', type=str, default="gpt-3.5-turbo")
+    parser.add_argument('--llm_mode', type=str, default='live', choices=['live', 'record', 'replay'],
+                        help='Call the api live, record the requests and responses, or replay them from the cassette.')
+    parser.add_argument('--llm_cassette_file', type=str, default=None,
+                        help='Append-only jsonl file of the recorded requests and responses.')
+    parser.add_argument('--api_base', type=str, default=None,
+                        help='Base url of an openai-compatible server, e.g., the one of scripts/openai_stub_server.py.')
+    parser.add_argument('--max_concurrent_requests', type=int, default=8,
+                        help='Max number of in-flight api requests per process.')
+    parser.add_argument('--completion_batch_size', type=int, default=1,
+                        help='Max number of prompts packed into one call for non-chat engines.')
+    parser.add_argument('--completion_batch_max_tokens', type=int, default=32000,
+                        help='Max prompt plus generation tokens of one batched call.')
+    parser.add_argument('--key_rpm_limit', type=int, default=3500,
+                        help='Requests per minute allowed for each api key.')
+    parser.add_argument('--key_tpm_limit', type=int, default=90000,
+                        help='Tokens per minute allowed for each api key.')
+    parser.add_argument('--llm_gateway', action='store_true',
+                        help='Whether send the api requests of all processes through one local gateway process.')
+    parser.add_argument('--qa_stream_map', action='store_true',
+                        help='Whether stream the map@ QA completions and stop once all the rows are mapped.')
+    parser.add_argument('--qa_map_max_retries', type=int, default=2,
+                        help='Times to retry a map@ QA chunk failed, or the rows missed in its output.')
+    parser.add_argument('--qa_map_chunking', type=str, default='tokens', choices=['tokens', 'rows'],
+                        help='Pack map@ QA rows into calls by token budget, or by fixed 50 rows.')
+    parser.add_argument('--qa_context_tokens', type=int, default=None,
+                        help='Context window of the QA engine, looked up by the engine name if not set.')
+    parser.add_argument('--disable_qa_map_dedup', action='store_true',
+                        help='Whether ask map@ QA on every row instead of once per distinct row.')
+    parser.add_argument('--disable_qa_memo', action='store_true',
+                        help='Whether ask the same QA on the same sub-table again instead of reusing the result.')
+    parser.add_argument('--qa_cache_file', type=str, default=None,
+                        help='SQLite file to persist the QA results across runs, in memory only if not set.')
+    parser.add_argument('--qa_cell_cache', action='store_true',
+                        help='Whether reuse the map@ QA answers of the same cells across tables.')
+    parser.add_argument('--disable_qa_dag', action='store_true',
+                        help='Whether run the QA steps of a program one by one instead of the independent ones together.')
+    parser.add_argument('--qa_dag_workers', type=int, default=8,
+                        help='Max number of independent QA steps of a program running at the same time.')
+    parser.add_argument('--qa_batch_size', type=int, default=16,
+                        help='Max number of QA prompts of the concurrent examples sent together.')
+    parser.add_argument('--qa_batch_window', type=float, default=0.02,
+                        help='Seconds to wait for more QA prompts before sending a batch.')
     parser.add_argument('--use_majority_vote', action='store_false',
                         help='Whether use majority vote to determine the prediction answer.')
+    parser.add_argument('--disable_early_exit_vote', action='store_true',
+                        help='Whether execute all the programs instead of stopping once the vote is decided.')
     parser.add_argument('--allow_none_and_empty_answer', action='store_true',
                         help='Whether regarding none and empty executions as a valid answer.')
     parser.add_argument('--allow_error_answer', action='store_true',
@@ -220,8 +355,15 @@ if __name__ == '__main__':
                         help='The weight of the answer to be biased in majority vote.')
     parser.add_argument('--process_program_with_fuzzy_match_on_db', action='store_false',
                         help='Whether use fuzzy match with db and program to improve on program.')
+    parser.add_argument('--completion_cache_file', type=str, default=None,
+                        help='SQLite file to cache api completions across runs, no cache if not set.')
+    parser.add_argument('--completion_cache_max_entries', type=int, default=100000)
+    parser.add_argument('--table_store_dir', type=str, default=None,
+                        help='Directory to persist the normalized tables across runs, in memory only if not set.')
 
     # Debugging options
+    parser.add_argument('--neuraldb_tmp_dir', type=str, default=None,
+                        help='Directory to keep the sqlite file of each program, in memory if not set.')
     parser.add_argument('--verbose', action='store_true')
 
     args = parser.parse_args()
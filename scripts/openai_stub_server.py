@@ -0,0 +1,258 @@
+"""
+Local openai-compatible stub server for offline load testing.
+Serve ChatCompletion and Completion requests from fixtures or simple rules,
+with injectable latency, rate limit 429s and context length errors.
+Point the pipeline to it by --api_base http://127.0.0.1:<port>/v1
+"""
+
+import json
+import argparse
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def load_fixtures(fixture_file):
+    """
+    Fixtures are a json list of {"pattern": regex, "text": completion}, the first pattern found in the prompt wins.
+    """
+    if not fixture_file:
+        return []
+    with open(fixture_file, 'r') as f:
+        fixtures = json.load(f)
+    return [(re.compile(fixture['pattern'], re.S), fixture['text']) for fixture in fixtures]
+
+
+def rule_based_completion(prompt: str):
+    """
+    Make a well-formed completion for the prompts of Binder.
+    """
+    if prompt.rstrip().endswith('row by row.'):
+        # map@ QA in new_db style, copy the table given and map each row to the same answer
+        table_block = prompt[prompt.rfind('/*'):prompt.rfind('*/') + 2].split('\n')
+        header, rows = table_block[1], table_block[2:-1]
+        lines = ['/*', '{}\tanswer'.format(header)] + ['{}\tyes'.format(row) for row in rows] + ['*/']
+        return '\n'.join(lines)
+    elif prompt.rstrip().endswith('A:'):
+        # ans@ QA
+        return ' yes'
+    else:
+        # NSQL generation
+        return 'SELECT COUNT(*) FROM w'
+
+
+def truncate_at_stop(text: str, stop):
+    if not stop:
+        return text
+    stop = [stop] if isinstance(stop, str) else stop
+    end = len(text)
+    for stop_token in stop:
+        pos = text.find(stop_token)
+        if pos != -1:
+            end = min(end, pos)
+    return text[:end]
+
+
+def count_words(text: str):
+    return len(text.split())
+
+
+class StubState(object):
+    """
+    Server settings and the per-key request log for the rpm limit.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.fixtures = load_fixtures(args.fixture_file)
+        self.key_requests = defaultdict(deque)
+        self.n_requests = 0
+        self.lock = threading.Lock()
+
+    def completion_text(self, prompt: str):
+        for pattern, text in self.fixtures:
+            if pattern.search(prompt):
+                return text
+        return rule_based_completion(prompt)
+
+    def is_rate_limited(self, key: str):
+        with self.lock:
+            self.n_requests += 1
+            if random.random() < self.args.rate_limit_prob:
+                return True
+            if self.args.rpm_limit:
+                now = time.time()
+                requests = self.key_requests[key]
+                while requests and now - requests[0] > 60:
+                    requests.popleft()
+                if len(requests) >= self.args.rpm_limit:
+                    return True
+                requests.append(now)
+            return False
+
+    def latency(self):
+        return max(0., random.gauss(self.args.latency_mean, self.args.latency_std))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body, is_chat, text):
+        """
+        Stream one choice as server-sent events, a few characters per chunk.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i in range(0, len(text), self.state.args.stream_chunk_chars):
+            piece = text[i:i + self.state.args.stream_chunk_chars]
+            choice = {"index": 0, "delta": {"content": piece}} if is_chat else {"index": 0, "text": piece}
+            chunk = {
+                "object": "chat.completion.chunk" if is_chat else "text_completion",
+                "model": body.get('model', None) or self.path.split('/')[-2],
+                "choices": [choice]
+            }
+            try:
+                self.wfile.write('data: {}\n\n'.format(json.dumps(chunk)).encode('utf-8'))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading early
+                return
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def _send_error(self, status, message, error_type, code=None, headers=None):
+        self._send_json(status, {
+            "error": {"message": message, "type": error_type, "param": None, "code": code}
+        }, headers=headers)
+
+    def do_POST(self):
+        args = self.state.args
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        key = self.headers.get('Authorization', '')
+        is_chat = self.path.endswith('/chat/completions')
+        if not self.path.endswith('/completions'):
+            self._send_error(404, "Unknown endpoint {}".format(self.path), "invalid_request_error")
+            return
+
+        time.sleep(self.state.latency())
+
+        if self.state.is_rate_limited(key):
+            self._send_error(429, "Rate limit reached for requests", "requests",
+                             headers={'Retry-After': str(args.retry_after)})
+            return
+
+        if is_chat:
+            prompts = ['\n'.join([message['content'] for message in body['messages']])]
+        else:
+            prompts = body['prompt'] if isinstance(body['prompt'], list) else [body['prompt']]
+        if random.random() < args.context_length_prob or \
+                (args.max_context_chars and max([len(prompt) for prompt in prompts]) > args.max_context_chars):
+            self._send_error(400, "This model's maximum context length is 4097 tokens, "
+                                  "however you requested more tokens. Please reduce your prompt.",
+                             "invalid_request_error", code="context_length_exceeded")
+            return
+
+        if body.get('stream', False):
+            self._send_stream(body, is_chat, truncate_at_stop(self.state.completion_text(prompts[0]),
+                                                              body.get('stop', None)))
+            return
+
+        n = body.get('n', 1)
+        choices, n_prompt_tokens, n_completion_tokens = [], 0, 0
+        for prompt_idx, prompt in enumerate(prompts):
+            text = truncate_at_stop(self.state.completion_text(prompt), body.get('stop', None))
+            n_prompt_tokens += count_words(prompt)
+            for i in range(n):
+                n_completion_tokens += count_words(text)
+                if is_chat:
+                    choices.append({
+                        "index": prompt_idx * n + i,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop"
+                    })
+                else:
+                    tokens = text.split(' ')
+                    choices.append({
+                        "index": prompt_idx * n + i,
+                        "text": text,
+                        "logprobs": {"tokens": tokens, "token_logprobs": [-0.1] * len(tokens)}
+                        if body.get('logprobs', None) else None,
+                        "finish_reason": "stop"
+                    })
+        self._send_json(200, {
+            "id": "stub-{}".format(self.state.n_requests),
+            "object": "chat.completion" if is_chat else "text_completion",
+            "created": int(time.time()),
+            "model": body.get('model', None) or self.path.split('/')[-2],
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": n_prompt_tokens,
+                "completion_tokens": n_completion_tokens,
+                "total_tokens": n_prompt_tokens + n_completion_tokens
+            }
+        })
+
+
+def main():
+    StubHandler.state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Openai stub server on http://{args.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {StubHandler.state.n_requests} requests.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--fixture_file', type=str, default=None,
+                        help='Json list of {"pattern", "text"} to answer prompts, rules are used if not matched.')
+
+    # Injected latency and errors
+    parser.add_argument('--latency_mean', type=float, default=0.5,
+                        help='Mean seconds of the response latency.')
+    parser.add_argument('--latency_std', type=float, default=0.2,
+                        help='Std seconds of the response latency.')
+    parser.add_argument('--rate_limit_prob', type=float, default=0.,
+                        help='Probability of answering a 429.')
+    parser.add_argument('--rpm_limit', type=int, default=None,
+                        help='Requests per minute allowed for each key, 429 beyond it.')
+    parser.add_argument('--retry_after', type=float, default=1.,
+                        help='Seconds in the Retry-After header of 429s.')
+    parser.add_argument('--context_length_prob', type=float, default=0.,
+                        help='Probability of answering a context length error.')
+    parser.add_argument('--max_context_chars', type=int, default=None,
+                        help='Prompts longer than this get a context length error.')
+
+    parser.add_argument('--stream_chunk_chars', type=int, default=4,
+                        help='Characters per chunk of streamed responses.')
+
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verbose', action='store_true')
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+    main()
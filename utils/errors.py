@@ -2,3 +2,12 @@ class DuplicateColumnsError(Exception):
     def __init__(self, msg):
         self.msg = msg
 
+
+class CassetteMissError(Exception):
+    # Raised in replay mode when a request is not on the cassette. The error handlers of the programs and examples
+    # re-raise it instead of counting an error vote, so replay fails loudly.
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
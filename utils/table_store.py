@@ -0,0 +1,136 @@
+"""
+Content-hashed store of the normalized tables, shared across the questions on the same table and across runs.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict
+
+import pandas as pd
+
+from utils.normalizer import prepare_df_for_neuraldb_from_table
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TableStore(object):
+    """
+    Map the content hash of (header, rows, normalize options) to the dataframe made by
+    prepare_df_for_neuraldb_from_table. Dataframes are kept in an in-memory LRU, and optionally persisted in
+    store_dir as parquet(dtypes included), or as pickle when pyarrow is not installed or can't write the frame.
+    """
+
+    def __init__(self, store_dir: str = None, max_entries: int = 1000):
+        self.store_dir = store_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        if self.store_dir:
+            os.makedirs(self.store_dir, exist_ok=True)
+
+    @staticmethod
+    def key(table: Dict, **kwargs) -> str:
+        return hashlib.sha256(json.dumps({
+            "header": table['header'],
+            "rows": table['rows'],
+            "kwargs": kwargs
+        }, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+    def prepare_df_for_neuraldb_from_table(self, table: Dict, **kwargs) -> pd.DataFrame:
+        """
+        Same as utils.normalizer.prepare_df_for_neuraldb_from_table, computed once per table content.
+        A copy is returned every time, so the callers are free to mutate it.
+        """
+        key = self.key(table, **kwargs)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return self._memo[key].copy()
+        df = self._load(key)
+        with self._lock:
+            if df is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if df is None:
+            df = prepare_df_for_neuraldb_from_table(table, **kwargs)
+            self._save(key, df)
+        with self._lock:
+            self._memo[key] = df
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return df.copy()
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.store_dir, key[:2], '{}.{}'.format(key, ext))
+
+    def _load(self, key: str):
+        if not self.store_dir:
+            return None
+        for ext, read in [('parquet', pd.read_parquet), ('pkl', pd.read_pickle)]:
+            path = self._path(key, ext)
+            if os.path.exists(path):
+                try:
+                    return read(path)
+                except Exception as e:
+                    print("Table store: failed to load {}, {}".format(path, e))
+        return None
+
+    def _save(self, key: str, df: pd.DataFrame):
+        if not self.store_dir:
+            return
+        os.makedirs(os.path.dirname(self._path(key, 'pkl')), exist_ok=True)
+        if pyarrow is not None:
+            try:
+                self._atomic_write(self._path(key, 'parquet'), lambda path: df.to_parquet(path, engine='pyarrow'))
+                return
+            except Exception:
+                # Mixed-type object columns can't be written by pyarrow
+                pass
+        self._atomic_write(self._path(key, 'pkl'), df.to_pickle)
+
+    @staticmethod
+    def _atomic_write(path: str, write):
+        # Concurrent processes may store the same table, readers never see a partial file
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4())
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stats(self) -> Dict:
+        n_queries = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_queries if n_queries else 0.
+        }
+
+
+_table_store = TableStore()
+
+
+def set_table_store_dir(store_dir: str = None):
+    """
+    Persist the normalized tables of this process in store_dir, in memory only if None.
+    """
+    global _table_store
+    if store_dir != _table_store.store_dir:
+        _table_store = TableStore(store_dir=store_dir)
+
+
+def get_table_store() -> TableStore:
+    return _table_store
@@ -6,6 +6,7 @@ import os
 from typing import List, Union, Dict
 from functools import cmp_to_key
 import math
+import threading
 from collections.abc import Iterable
 
 from datasets import load_dataset
@@ -44,6 +45,67 @@ def _load_table(table_path) -> dict:
     return table_item
 
 
+_gpt2_tokenizer = None
+_gpt2_tokenizer_lock = threading.Lock()
+
+
+def get_gpt2_tokenizer():
+    """
+    Load the local GPT-2 tokenizer once per process, the QA steps may ask for it from several threads.
+    """
+    global _gpt2_tokenizer
+    with _gpt2_tokenizer_lock:
+        if _gpt2_tokenizer is None:
+            from transformers import AutoTokenizer
+            _gpt2_tokenizer = AutoTokenizer.from_pretrained(
+                pretrained_model_name_or_path=os.path.join(ROOT_DIR, "utils", "gpt2"))
+    return _gpt2_tokenizer
+
+
+def count_tokens(text: str) -> int:
+    """
+    Number of GPT-2 tokens of the text.
+    """
+    return len(get_gpt2_tokenizer().tokenize(text))
+
+
+def _vote_candidate_answers(
+        nsqls: List,
+        pred_answer_list: List,
+        allow_none_and_empty_answer: bool = False,
+        allow_error_answer: bool = False,
+        answer_placeholder: Union[str, int] = '<error|empty>'
+):
+    """
+    Group the valid execution answers with their count and nsqls.
+    """
+    candi_answer_dict = dict()
+    for (nsql, logprob), pred_answer in zip(nsqls, pred_answer_list):
+        if allow_none_and_empty_answer:
+            if pred_answer == [None] or pred_answer == []:
+                pred_answer = [answer_placeholder]
+        if allow_error_answer:
+            if pred_answer == '<error>':
+                pred_answer = [answer_placeholder]
+
+        # Invalid execution results, and the programs skipped once the vote is decided
+        if pred_answer == '<error>' or pred_answer == '<skipped>' or pred_answer == [None] or pred_answer == []:
+            continue
+        if candi_answer_dict.get(tuple(pred_answer), None) is None:
+            candi_answer_dict[tuple(pred_answer)] = {
+                'count': 0,
+                'nsqls': []
+            }
+        answer_info = candi_answer_dict.get(tuple(pred_answer), None)
+        answer_info['count'] += 1
+        answer_info['nsqls'].append([nsql, logprob])
+    return candi_answer_dict
+
+
+def _lf_weight(nsql: str):
+    return 10 if 'map@' in nsql or 'ans@' in nsql else 1
+
+
 def majority_vote(
         nsqls: List,
         pred_answer_list: List,
@@ -82,26 +144,13 @@ def majority_vote(
             [math.exp(nsql[1]) for nsql in b[1]['nsqls']]) else -1
 
     # Vote answers
-    candi_answer_dict = dict()
-    for (nsql, logprob), pred_answer in zip(nsqls, pred_answer_list):
-        if allow_none_and_empty_answer:
-            if pred_answer == [None] or pred_answer == []:
-                pred_answer = [answer_placeholder]
-        if allow_error_answer:
-            if pred_answer == '<error>':
-                pred_answer = [answer_placeholder]
-
-        # Invalid execution results
-        if pred_answer == '<error>' or pred_answer == [None] or pred_answer == []:
-            continue
-        if candi_answer_dict.get(tuple(pred_answer), None) is None:
-            candi_answer_dict[tuple(pred_answer)] = {
-                'count': 0,
-                'nsqls': []
-            }
-        answer_info = candi_answer_dict.get(tuple(pred_answer), None)
-        answer_info['count'] += 1
-        answer_info['nsqls'].append([nsql, logprob])
+    candi_answer_dict = _vote_candidate_answers(
+        nsqls=nsqls,
+        pred_answer_list=pred_answer_list,
+        allow_none_and_empty_answer=allow_none_and_empty_answer,
+        allow_error_answer=allow_error_answer,
+        answer_placeholder=answer_placeholder
+    )
 
     # All candidates execution errors
     if len(candi_answer_dict) == 0:
@@ -145,6 +194,94 @@ def majority_vote(
     return pred_answer, pred_answer_nsqls
 
 
+def majority_vote_scores(
+        nsqls: List,
+        pred_answer_list: List,
+        allow_none_and_empty_answer: bool = False,
+        allow_error_answer: bool = False,
+        answer_placeholder: Union[str, int] = '<error|empty>',
+        vote_method: str = 'prob',
+        answer_biased: Union[str, int] = None,
+        answer_biased_weight: float = None,
+):
+    """
+    The score of each candidate answer which majority_vote sorts by, in descending order.
+    """
+    candi_answer_dict = _vote_candidate_answers(
+        nsqls=nsqls,
+        pred_answer_list=pred_answer_list,
+        allow_none_and_empty_answer=allow_none_and_empty_answer,
+        allow_error_answer=allow_error_answer,
+        answer_placeholder=answer_placeholder
+    )
+    answer_scores = []
+    for answer, answer_dict in candi_answer_dict.items():
+        if vote_method == 'simple':
+            score = answer_dict['count']
+        elif vote_method == 'prob':
+            score = sum([math.exp(nsql[1]) for nsql in answer_dict['nsqls']])
+        elif vote_method == 'answer_biased':
+            score = answer_dict['count'] * (answer_biased_weight if answer == (answer_biased,) else 1)
+        elif vote_method == 'lf_biased':
+            score = sum([_lf_weight(nsql) for nsql, _ in answer_dict['nsqls']])
+        else:
+            raise ValueError(f"Vote method {vote_method} is not supported.")
+        answer_scores.append((list(answer), score))
+    return sorted(answer_scores, key=lambda x: x[1], reverse=True)
+
+
+def majority_vote_is_decided(
+        nsqls: List,
+        pred_answer_list: List,
+        n_remaining: int,
+        remaining_nsqls: List = None,
+        allow_none_and_empty_answer: bool = False,
+        allow_error_answer: bool = False,
+        answer_placeholder: Union[str, int] = '<error|empty>',
+        vote_method: str = 'prob',
+        answer_biased: Union[str, int] = None,
+        answer_biased_weight: float = None,
+):
+    """
+    Whether the n_remaining programs not executed yet can no longer change the winner of majority_vote.
+    The remaining (nsql, logprob) pairs tighten the bound when known, which is required by the 'prob' vote.
+    """
+    answer_scores = majority_vote_scores(
+        nsqls=nsqls,
+        pred_answer_list=pred_answer_list,
+        allow_none_and_empty_answer=allow_none_and_empty_answer,
+        allow_error_answer=allow_error_answer,
+        answer_placeholder=answer_placeholder,
+        vote_method=vote_method,
+        answer_biased=answer_biased,
+        answer_biased_weight=answer_biased_weight
+    )
+    if n_remaining == 0:
+        return True
+    if len(answer_scores) == 0:
+        return False
+
+    # The most score the remaining programs could add to any one answer
+    if vote_method == 'simple':
+        max_remaining_score = n_remaining
+    elif vote_method == 'answer_biased':
+        max_remaining_score = n_remaining * max(1, answer_biased_weight)
+    elif vote_method == 'lf_biased':
+        max_remaining_score = sum([_lf_weight(nsql) for nsql, _ in remaining_nsqls]) \
+            if remaining_nsqls is not None else n_remaining * 10
+    elif vote_method == 'prob':
+        if remaining_nsqls is None:
+            return False
+        max_remaining_score = sum([math.exp(logprob) for _, logprob in remaining_nsqls])
+    else:
+        raise ValueError(f"Vote method {vote_method} is not supported.")
+
+    leader_score = answer_scores[0][1]
+    runner_up_score = answer_scores[1][1] if len(answer_scores) > 1 else 0
+    # Strictly larger, since ties are broken by the nsql logprob which may change
+    return leader_score - runner_up_score > max_remaining_score
+
+
 def load_data_split(dataset_to_load, split, data_dir=os.path.join(ROOT_DIR, 'datasets/')):
     dataset_split_loaded = load_dataset(
         path=os.path.join(data_dir, "{}.py".format(dataset_to_load)),